@@ -6,7 +6,6 @@ import random
 import graphsort
 
 from distribution import DistrCall, Distribution, LiteralRef, LocalVariable
-from model import DistrResult, Model
 
 
 def resolveValue(values, val):
@@ -24,20 +23,137 @@ def addValues(values, variables, result):
   for v,r in zip(variables, result):
     values[v] = r
 
+class PlanStep(object):
+  """
+  One assignment of a DistributionPlan.  params holds, for each parameter of
+  the call, either a slot number or a constant DistrValue.  If no parameter
+  refers to a slot, call is the (fixed) DistrCall of the step.
+  """
 
-# def distributionLiteralRefs(distr):
-#   res = []
-#   def process(value):
-#     if isinstance(value, LiteralRef):
-#       res.append(value)
-#   for call in distr.calls:
-#     for param in call.parameters:
-#       process(param)
-#   for result in distr.result:
-#     process(result)
-#   return res
+  __slots__ = ('function', 'params', 'outputs', 'variables', 'call')
 
+  def __init__(self, function, params, outputs, variables):
+    self.function = function
+    self.params = params
+    self.outputs = outputs
+    self.variables = variables
+    self.call = None
+    if not any(isinstance(p, int) for p in params):
+      self.call = DistrCall(function, params)
 
+class DistributionPlan(object):
+  """
+  A Distribution compiled for repeated evaluation.  Each variable is given an
+  integer slot, so evaluating the plan works on a list of slotCount values
+  rather than a dict of names.
+  """
 
+  def __init__(self, distr):
+    assert isinstance(distr, Distribution)
+    slotOf = {}
+    def compileValue(value):
+      if isinstance(value, LocalVariable):
+        return slotOf[value.name]
+      return value
+    self.steps = []
+    for assn in distr.assignments:
+      params = tuple(compileValue(p) for p in assn.call.parameters)
+      outputs = []
+      for v in assn.variables:
+        slotOf[v] = len(slotOf)
+        outputs.append(slotOf[v])
+      self.steps.append(
+        PlanStep(assn.call.function, params, tuple(outputs), assn.variables))
+    self.slotCount = len(slotOf)
+    self.result = tuple(compileValue(r) for r in distr.result)
+    # how many times each slot is used, as a parameter or in the result
+    self.slotUses = [0] * self.slotCount
+    for step in self.steps:
+      for p in step.params:
+        if p.__class__ is int:
+          self.slotUses[p] += 1
+    for r in self.result:
+      if r.__class__ is int:
+        self.slotUses[r] += 1
+    self.liveSteps = None
+    self.liveSlotUses = None
+    self.deadConstants = None
 
+  def computeLiveness(self):
+    """
+    Finds the steps the result depends on, by a backward pass from the
+    result.  Sets liveSteps to them (in order), liveSlotUses to the uses of
+    each slot by live steps and the result, and deadConstants to the
+    LiteralRef parameters of the other steps, with repeats.
+    """
+    if self.liveSteps is not None:
+      return
+    live = [False] * self.slotCount
+    for r in self.result:
+      if r.__class__ is int:
+        live[r] = True
+    liveSteps = []
+    deadConstants = []
+    for step in reversed(self.steps):
+      if any(live[o] for o in step.outputs):
+        liveSteps.append(step)
+        for p in step.params:
+          if p.__class__ is int:
+            live[p] = True
+      else:
+        deadConstants.extend(p for p in step.params if isinstance(p, LiteralRef))
+    liveSteps.reverse()
+    liveSlotUses = [0] * self.slotCount
+    for step in liveSteps:
+      for p in step.params:
+        if p.__class__ is int:
+          liveSlotUses[p] += 1
+    for r in self.result:
+      if r.__class__ is int:
+        liveSlotUses[r] += 1
+    self.liveSteps = liveSteps
+    self.liveSlotUses = liveSlotUses
+    self.deadConstants = deadConstants
 
+  def newSlots(self):
+    return [None] * self.slotCount
+
+  def resolveCall(self, slots, step):
+    if step.call is not None:
+      return step.call
+    return DistrCall(step.function,
+                     [slots[p] if p.__class__ is int else p for p in step.params])
+
+  def setOutputs(self, slots, step, result):
+    outputs = step.outputs
+    assert len(result) == len(outputs)
+    for i in range(len(outputs)):
+      slots[outputs[i]] = result[i]
+
+  def resolveResult(self, slots):
+    return tuple(slots[r] if r.__class__ is int else r for r in self.result)
+
+def compileDistribution(distr):
+  """
+  Returns the DistributionPlan for distr, compiling it on first use.
+  """
+  if distr.plan is None:
+    distr.plan = DistributionPlan(distr)
+  return distr.plan
+
+
+def distributionLiteralRefs(distr):
+  """
+  Returns every occurrence of a LiteralRef in distr (in its calls'
+  parameters and its result), with repeats.
+  """
+  res = []
+  def process(value):
+    if isinstance(value, LiteralRef):
+      res.append(value)
+  for assn in distr.assignments:
+    for param in assn.call.parameters:
+      process(param)
+  for result in distr.result:
+    process(result)
+  return res
@@ -1,11 +1,26 @@
 from collections import defaultdict
+import contextvars
+import itertools
+import json
+import sys
+import threading
 
 from distribution import DistrCall, DistrCallAssignment, Distribution, LocalVariable, LiteralRef, CallRef
 from model import DistrResult, Model
+import graphsort
+import primitives
 
-def export(onlyFun=None):
+def export(onlyFun=None, domain=None):
+  """
+  Marks a method of a PythonDistributionSystem as a distribution function.
+  Use as @export, or as @export(domain=...) where domain lists every tuple
+  of arguments the function can be called with; functions with a (small)
+  finite domain can be tabulated by PythonDistributionSystem.precompute.
+  """
   def wrapper(f):
     f._defmodel_export = True
+    if domain is not None:
+      f._defmodel_domain = [tuple(args) for args in domain]
     return f
   if hasattr(onlyFun, '__call__'):
     return wrapper(onlyFun)
@@ -14,6 +29,9 @@ def export(onlyFun=None):
 def isExport(f):
   return hasattr(f, '_defmodel_export') and f._defmodel_export
 
+def getDomain(f):
+  return getattr(f, '_defmodel_domain', None)
+
 class LocalVariableContext:
 
   def __init__(self):
@@ -66,75 +84,429 @@ class PythonDistributionSystem(object):
   A system of distribution functions, represented as a Python class.
 
   The class should @export distribution functions.
+
+  Running a distribution function records which distribution functions it
+  calls in callGraph; see traceCall, getSchedule and precompute.
+
+  Distribution functions may run in several threads at once: each thread has
+  its own call stack.
   """
 
   def __init__(self):
-    self.callStack = []
+    self.local = threading.local()
     self.functions = {}
+    self.domains = {}
+    # maps each distribution function to the set of functions it was seen
+    # calling; the sets are updated under callGraphLock
+    self.callGraph = {}
+    self.callGraphLock = threading.Lock()
     for name in dir(type(self)):
       # this is necessary because of weird closure semantics
       def loopBody(name, towrap):
         if isExport(towrap):
-          if name != 'bernouli':
+          if not primitives.isPrimitive(name):
+            callees = self.callGraph[name] = set()
             def distrFunction(args):
               ctx = LocalVariableContext()
-              self.callStack.append(ctx)
+              callStack = self.callStack
+              callStack.append(ctx)
               args = list(args)
-              res = towrap(ctx, *args)
-              return self.callStack.pop().getAssignments(), res
+              try:
+                res = towrap(ctx, *args)
+              finally:
+                callStack.pop()
+              assignments = ctx.getAssignments()
+              with self.callGraphLock:
+                callees.update(callee for callee, _, _ in assignments)
+              return assignments, res
             self.functions[name] = distrFunction
+            if getDomain(towrap) is not None:
+              self.domains[name] = getDomain(towrap)
 
           def wrapped(*args):
-            res = CallRef(len(self.callStack[-1].calls), 0)
-            self.callStack[-1].addCall((name, args))
+            ctx = self.callStack[-1]
+            res = CallRef(len(ctx.calls), 0)
+            ctx.addCall((name, args))
             return res
           wrapped.__name__ = name
           setattr(self, name, wrapped)
       loopBody(name, getattr(self, name))
 
 
+  @property
+  def callStack(self):
+    """
+    The LocalVariableContexts of the distribution functions running in the
+    current thread, innermost last.
+    """
+    try:
+      return self.local.callStack
+    except AttributeError:
+      self.local.callStack = []
+      return self.local.callStack
+
   def getModel(self):
     return PythonFunctionModel(self.functions)
 
+  def traceCall(self, name, *args):
+    """
+    Runs a distribution function on the given arguments (Python objects) only
+    to record the functions it calls.
+    """
+    self.functions[name](args)
+
+  def getSchedule(self):
+    """
+    Orders the strongly connected components of the call graph bottom-up
+    (callees before callers).  Returns a list of (functions, precomputable)
+    pairs; a component is precomputable if it is a single function that
+    isn't recursive and has a domain.
+
+    Only calls seen so far are in the call graph: trace the functions (or run
+    the model) first.
+    """
+    with self.callGraphLock:
+      graph = dict((name, [callee for callee in callees if callee in self.callGraph])
+                   for name, callees in self.callGraph.items())
+    schedule = []
+    for component in reversed(graphsort.robust_topological_sort(graph)):
+      recursive = len(component) > 1 or component[0] in graph[component[0]]
+      precomputable = not recursive and component[0] in self.domains
+      schedule.append((component, precomputable))
+    return schedule
+
+  def precompute(self):
+    """
+    Traces every function with a domain over its domain, then tabulates the
+    precomputable ones (see getSchedule), bottom-up.  A tabulated function
+    answers calls with arguments in its domain from the table rather than
+    running again; the models of this system see the change too.
+
+    Returns the schedule.
+    """
+    for name, domain in self.domains.items():
+      for args in domain:
+        self.traceCall(name, *args)
+    schedule = self.getSchedule()
+    for component, precomputable in schedule:
+      if precomputable:
+        self.tabulate(component[0])
+    return schedule
+
+  def tabulate(self, name):
+    compute = self.functions[name]
+    table = {}
+    for args in self.domains[name]:
+      table[argsKey(args)] = compute(args)
+    def tabulated(args):
+      args = list(args)
+      key = argsKey(args)
+      if key in table:
+        return table[key]
+      return compute(args)
+    self.functions[name] = tabulated
+
+  # stubs for the primitives (see primitives.py), which are never run: a
+  # call to one is recorded like any other, and the sampler handles it
+
   @export
   def bernouli(self, prob):
     raise Exception("can't call bernouli in PythonDistributionSystem")
 
+  @export
+  def categorical(self, probs):
+    raise Exception("can't call categorical in PythonDistributionSystem")
+
+  @export
+  def uniformInt(self, lo, hi):
+    raise Exception("can't call uniformInt in PythonDistributionSystem")
+
+  @export
+  def binomial(self, n, prob):
+    raise Exception("can't call binomial in PythonDistributionSystem")
+
+  @export
+  def beta(self, a, b):
+    raise Exception("can't call beta in PythonDistributionSystem")
+
+def internKey(obj):
+  """
+  A hashable key such that two objects have equal keys iff. they have the
+  same canonical JSON, or None if obj can't be converted to JSON.  Scalars
+  keep their type, so 1, 1.0 and True differ; floats are keyed by repr, so
+  0.0 and -0.0 differ too.
+  """
+  if obj is None or isinstance(obj, (bool, int, str)):
+    return (type(obj), obj)
+  if isinstance(obj, float):
+    return (float, repr(obj))
+  try:
+    return ('json', json.dumps(obj, sort_keys=True))
+  except (TypeError, ValueError):
+    return None
+
+def internedObject(obj, key):
+  """
+  The object to store for obj under the intern key key: containers are
+  replaced by the parsed canonical JSON, so all values with that key read
+  back the same (tuples as lists, dict keys as strings), and the model
+  never shares an object with its caller.
+  """
+  if key is not None and key[0] == 'json':
+    return json.loads(key[1])
+  return obj
+
+def objectSize(obj):
+  """
+  Approximate memory used by obj in bytes, following lists, tuples and
+  dicts.
+  """
+  size = sys.getsizeof(obj)
+  if isinstance(obj, (list, tuple)):
+    size += sum(objectSize(x) for x in obj)
+  elif isinstance(obj, dict):
+    size += sum(objectSize(k) + objectSize(v) for k, v in obj.items())
+  return size
+
+class Arena(object):
+  """
+  Tracks the references a PythonFunctionModel hands out while the arena is
+  open, so that those its holders never released can be released at once
+  when it closes (for example at the end of a sample).
+
+  A reference is taken when JSONToRef or a distribution returns a value,
+  whether the ref is new or an interned one that already existed; releasing
+  a ref gives one back to the innermost arena holding one.  Closing releases
+  what is left with modifyReferenceCount, so a ref survives as long as
+  anyone else (a DistributionCache, say, or whoever held it before the arena
+  opened) still holds a reference.  References taken by modifyReferenceCount
+  aren't tracked, since the arena can't tell them from references kept on
+  purpose; so a result handed out by a DistributionCache hit must still be
+  released by its holder.
+
+  References that are still needed afterwards must be passed to close as
+  keep, one occurrence per reference; they are handed on to the enclosing
+  arena, if any.
+  """
+
+  def __init__(self, model):
+    self.model = model
+    # maps refs (as ints) to the number of references taken and not given back;
+    # an entry is only changed under the lock of its ref's shard
+    self.counts = {}
+    self.closed = False
+
+  def take(self, ref):
+    self.counts[ref] = self.counts.get(ref, 0) + 1
+
+  def giveBack(self, ref, count):
+    """
+    Gives back up to count references to ref, returning how many it held.
+    """
+    held = self.counts.get(ref, 0)
+    if held <= count:
+      self.counts.pop(ref, None)
+      return held
+    self.counts[ref] = held - count
+    return count
+
+  def close(self, keep=()):
+    """
+    Closes the arena, unless it is closed already (as when closed inside a
+    with block).
+    """
+    if self.closed:
+      return
+    self.closed = True
+    model = self.model
+    stack = openArenas.get()
+    assert stack[-1] is self
+    openArenas.set(stack[:-1])
+    arenas = model.arenas
+    counts = self.counts
+    self.counts = {}
+    for r in keep:
+      with model.shardOf(r.ref).lock:
+        if counts.get(r.ref, 0) > 0:
+          counts[r.ref] -= 1
+          if len(arenas) > 0:
+            arenas[-1].take(r.ref)
+    # released on the shards directly: these are the arena's own
+    # references, not to be given back by the enclosing arenas
+    for ref, count in counts.items():
+      if count > 0:
+        shard = model.shardOf(ref)
+        with shard.lock:
+          shard.changeCount(ref, -count)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+# the Arenas open in the current context, innermost last; worker threads of a
+# ThreadPoolModel run in a copy of the submitting context
+openArenas = contextvars.ContextVar('openArenas', default=())
+
+def argsKey(args):
+  """
+  A hashable key for a list of arguments (see internKey), or None.
+  """
+  keys = tuple(internKey(arg) for arg in args)
+  if any(key is None for key in keys):
+    return None
+  return keys
+
+class RefShard(object):
+  """
+  One shard of the tables of a PythonFunctionModel: the objects of the refs
+  congruent to index modulo PythonFunctionModel.SHARDS, and the intern keys
+  that hash to this shard, all guarded by lock.
+  """
+
+  def __init__(self, index):
+    self.index = index
+    self.lock = threading.Lock()
+    # maps refs (as ints) to [object, reference count]
+    self.referenced = {}
+    # maps intern keys to refs and back
+    self.interned = {}
+    self.internKeys = {}
+    self.nextId = 0
+
+  def newReference(self):
+    res = self.nextId * PythonFunctionModel.SHARDS + self.index
+    self.nextId += 1
+    return res
+
+  def changeCount(self, ref, delta):
+    """
+    Adds delta to the reference count of ref, deleting its object when it
+    drops to 0.  The caller holds lock.
+    """
+    data = self.referenced[ref]
+    newCount = data[1] + delta
+    assert newCount >= 0
+    if newCount == 0:
+      self.freeReference(ref)
+    else:
+      data[1] = newCount
+
+  def freeReference(self, ref):
+    """
+    Deletes the object with the given ref, whatever its reference count.
+    """
+    del self.referenced[ref]
+    key = self.internKeys.pop(ref, None)
+    if key is not None:
+      del self.interned[key]
+
 class PythonFunctionModel(Model):
   """
   A model made of Python functions.
 
   Usually derived from a PythonDistributionSystem.
+
+  Values are hash-consed: interning a value equal (as canonical JSON) to a
+  live value returns the live value's LiteralRef, with its reference count
+  increased, so equal values share one ref and isEqual compares refs.  A
+  JSON container is stored as its canonical JSON parsed again (see
+  internedObject); the objects read back are shared by every holder of the
+  ref, so they must not be mutated.
+
+  The model can be used from several threads at once.  Its tables are split
+  into SHARDS RefShards, each with its own lock: a ref lives in shard
+  ref % SHARDS, and an interned value in the shard picked by its intern key,
+  so every operation takes exactly one shard's lock.  No lock is held while
+  a distribution function runs.  Arenas belong to the context (thread, or
+  ThreadPoolModel submission) that opened them.
   """
 
+  SHARDS = 16
+
   def __init__(self, functions):
     self.functions = functions
-    self.referenced = {}
-    self.referenceCount = 0
-
-  def newReference(self):
-    res = self.referenceCount
-    self.referenceCount += 1
-    return LiteralRef(res)
+    self.shards = [RefShard(i) for i in range(PythonFunctionModel.SHARDS)]
+    # spreads values that can't be interned over the shards
+    self.spread = itertools.count()
+
+  @property
+  def arenas(self):
+    """
+    The Arenas of this model open in the current context, innermost last.
+    """
+    stack = openArenas.get()
+    if len(stack) == 0:
+      return stack
+    return [arena for arena in stack if arena.model is self]
+
+  def shardOf(self, ref):
+    return self.shards[ref % PythonFunctionModel.SHARDS]
+
+  def arena(self):
+    """
+    Opens an Arena, which tracks the references taken in the current context
+    until it is closed.  Use as "with model.arena() as arena: ...".
+    """
+    arena = Arena(self)
+    openArenas.set(openArenas.get() + (arena,))
+    return arena
+
+  def getStats(self):
+    """
+    Returns the number of live refs, how many of them are interned, and the
+    approximate number of bytes used by their objects.
+    """
+    stats = {'liveRefs': 0, 'internedRefs': 0, 'bytes': 0}
+    for shard in self.shards:
+      with shard.lock:
+        stats['liveRefs'] += len(shard.referenced)
+        stats['internedRefs'] += len(shard.internKeys)
+        stats['bytes'] += sum(objectSize(data[0])
+                              for data in shard.referenced.values())
+    return stats
 
   def distrValueToObject(self, value):
     assert isinstance(value, LiteralRef)
-    assert value.ref in self.referenced
-    res = self.referenced[value.ref][0]
-    #self.modifyReferenceCount(value, -1)
+    # the caller's reference keeps the object alive until it is released
+    res = self.shardOf(value.ref).referenced[value.ref][0]
+    self.modifyReferenceCount(value, -1)
     return res
 
   def internObject(self, obj):
-    ref = self.newReference()
-    self.referenced[ref.ref] = [obj, 1]
-    return ref
+    key = internKey(obj)
+    if key is not None:
+      shard = self.shards[hash(key) % PythonFunctionModel.SHARDS]
+    else:
+      shard = self.shards[next(self.spread) % PythonFunctionModel.SHARDS]
+    with shard.lock:
+      if key is not None:
+        ref = shard.interned.get(key)
+        if ref is not None:
+          shard.referenced[ref][1] += 1
+          self.takeReference(ref)
+          return LiteralRef(ref)
+      ref = shard.newReference()
+      shard.referenced[ref] = [internedObject(obj, key), 1]
+      if key is not None:
+        shard.interned[key] = ref
+        shard.internKeys[ref] = key
+      self.takeReference(ref)
+    return LiteralRef(ref)
+
+  def takeReference(self, ref):
+    arenas = self.arenas
+    if len(arenas) > 0:
+      arenas[-1].take(ref)
 
   def JSONToRef(self, obj):
     return self.internObject(obj)
 
   def refToJSON(self, ref):
     assert isinstance(ref, LiteralRef)
-    return self.referenced[ref.ref][0]
+    # a single dict lookup is atomic, so no lock is needed
+    return self.shardOf(ref.ref).referenced[ref.ref][0]
 
   def objectToDistrValue(self, obj):
     assert not isinstance(obj, CallRef)
@@ -144,7 +516,9 @@ class PythonFunctionModel(Model):
     return self.internObject(obj)
 
   def getDistribution(self, call):
-    calls,ret = self.functions[call.function](map(self.distrValueToObject, call.parameters))
+    # the parameters are converted first, so the function runs without the lock
+    args = [self.distrValueToObject(p) for p in call.parameters]
+    calls,ret = self.functions[call.function](args)
     distr = Distribution(
       [DistrCallAssignment(
         DistrCall(function, map(self.objectToDistrValue, parameters)),
@@ -157,12 +531,19 @@ class PythonFunctionModel(Model):
   def modifyReferenceCount(self, ref, inc):
     assert isinstance(ref, LiteralRef)
     ref = ref.ref
-    assert ref in self.referenced
-    data = self.referenced[ref]
-    newCount = data[1] + inc
-    assert newCount >= 0
-    if newCount == 0:
-      del self.referenced[ref]
-    else:
-      data[1] = newCount
-
+    shard = self.shardOf(ref)
+    with shard.lock:
+      assert ref in shard.referenced
+      if inc < 0:
+        toGive = -inc
+        for arena in reversed(self.arenas):
+          toGive -= arena.giveBack(ref, toGive)
+          if toGive == 0:
+            break
+      shard.changeCount(ref, inc)
+
+  def isEqual(self, aref, bref):
+    if aref.ref in self.shardOf(aref.ref).internKeys and \
+       bref.ref in self.shardOf(bref.ref).internKeys:
+      return aref.ref == bref.ref
+    return Model.isEqual(self, aref, bref)
@@ -0,0 +1,162 @@
+import hashlib
+import inspect
+import json
+import sqlite3
+import threading
+
+from distribution import DistrCall, Distribution, LiteralRef
+from model import DistrResult, Model
+
+def fingerprint(system):
+  """
+  A version fingerprint for a model built from system (for example a
+  PythonDistributionSystem): a hash of the source of its class and every
+  base class but object.  Editing a distribution function changes it.
+  """
+  digest = hashlib.sha256()
+  for cls in type(system).__mro__[:-1]:
+    digest.update(cls.__qualname__.encode('utf-8'))
+    try:
+      digest.update(inspect.getsource(cls).encode('utf-8'))
+    except (OSError, TypeError):
+      pass
+  return digest.hexdigest()
+
+def canonicalJSON(obj):
+  return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+
+class PersistentCacheModel(Model):
+  """
+  Wraps a model with a persistent cache of getDistribution results, kept in
+  an SQLite database at path so that they survive restarts.
+
+  Entries are keyed by a hash of the called function and the JSON values of
+  its parameters, so they don't depend on the refs of any one process.
+  Distributions are stored with their LiteralRefs replaced by JSON values,
+  and get fresh refs when loaded.  Each entry records the fingerprint of the
+  model that computed it; entries from other fingerprints are deleted when
+  the cache is opened and are never returned.  A process still running with
+  an older fingerprint keeps adding entries under it, alongside (never in
+  place of) the current ones.
+
+  The database is in WAL mode, so several processes (and threads, each with
+  its own connection) can share it.
+  """
+
+  def __init__(self, wrapped, path, fingerprint, timeout=30.0):
+    self.wrapped = wrapped
+    self.path = path
+    self.fingerprint = fingerprint
+    self.timeout = timeout
+    self.local = threading.local()
+    self.hits = 0
+    self.misses = 0
+    db = self.connection()
+    with db:
+      primaryKey = [row[1] for row in db.execute('PRAGMA table_info(distributions)')
+                    if row[5] > 0]
+      if primaryKey == ['key']:
+        # an older cache keyed by call alone; its entries are just dropped
+        db.execute('DROP TABLE distributions')
+      db.execute('CREATE TABLE IF NOT EXISTS distributions ('
+                 'key TEXT NOT NULL, fingerprint TEXT NOT NULL, '
+                 'distribution TEXT NOT NULL, time REAL NOT NULL, '
+                 'PRIMARY KEY (key, fingerprint))')
+      db.execute('DELETE FROM distributions WHERE fingerprint != ?',
+                 (fingerprint,))
+
+  def connection(self):
+    db = getattr(self.local, 'db', None)
+    if db is None:
+      db = sqlite3.connect(self.path, timeout=self.timeout)
+      db.execute('PRAGMA journal_mode=WAL')
+      db.execute('PRAGMA synchronous=NORMAL')
+      self.local.db = db
+    return db
+
+  def callKey(self, call):
+    """
+    The content hash identifying call, from its function and the values (not
+    the refs) of its parameters.
+    """
+    values = [self.wrapped.refToJSON(p) for p in call.parameters]
+    text = canonicalJSON([call.function, values])
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+  def encodeDistribution(self, distr):
+    """
+    distr.toJSON(), with each LiteralRef replaced by its value.
+    """
+    def encodeValue(value):
+      if isinstance(value, LiteralRef):
+        return {'type': 'value', 'value': self.wrapped.refToJSON(value)}
+      return value.toJSON()
+    return canonicalJSON({
+      'assignments': [{'call': {'function': a.call.function,
+                                'parameters': [encodeValue(p) for p in a.call.parameters]},
+                       'variables': list(a.variables)}
+                      for a in distr.assignments],
+      'result': [encodeValue(r) for r in distr.result]})
+
+  def decodeDistribution(self, text):
+    """
+    Inverts encodeDistribution, giving each value occurrence a new reference.
+    """
+    jsonObj = json.loads(text)
+    def decodeValue(value):
+      if value['type'] == 'value':
+        return self.wrapped.JSONToRef(value['value']).toJSON()
+      return value
+    for a in jsonObj['assignments']:
+      a['call']['parameters'] = [decodeValue(p) for p in a['call']['parameters']]
+    jsonObj['result'] = [decodeValue(r) for r in jsonObj['result']]
+    return Distribution.fromJSON(jsonObj)
+
+  def getDistribution(self, call):
+    assert isinstance(call, DistrCall)
+    key = self.callKey(call)
+    db = self.connection()
+    row = db.execute(
+      'SELECT distribution, time FROM distributions WHERE key = ? AND fingerprint = ?',
+      (key, self.fingerprint)).fetchone()
+    if row is not None:
+      self.hits += 1
+      for p in call.parameters:
+        self.wrapped.modifyReferenceCount(p, -1)
+      return DistrResult(self.decodeDistribution(row[0]), row[1])
+    self.misses += 1
+    result = self.wrapped.getDistribution(call)
+    with db:
+      db.execute('INSERT OR IGNORE INTO distributions VALUES (?, ?, ?, ?)',
+                 (key, self.fingerprint,
+                  self.encodeDistribution(result.distribution), result.time))
+    return result
+
+  def clear(self):
+    db = self.connection()
+    with db:
+      db.execute('DELETE FROM distributions')
+
+  def getStats(self):
+    db = self.connection()
+    entries = db.execute('SELECT COUNT(*) FROM distributions').fetchone()[0]
+    return {'entries': entries, 'hits': self.hits, 'misses': self.misses}
+
+  def close(self):
+    db = getattr(self.local, 'db', None)
+    if db is not None:
+      db.close()
+      self.local.db = None
+
+  def modifyReferenceCount(self, ref, delta):
+    self.wrapped.modifyReferenceCount(ref, delta)
+
+  def JSONToRef(self, jsonObj):
+    return self.wrapped.JSONToRef(jsonObj)
+
+  def refToJSON(self, ref):
+    return self.wrapped.refToJSON(ref)
+
+  def isEqual(self, aref, bref):
+    return self.wrapped.isEqual(aref, bref)
@@ -2,6 +2,7 @@
 
 import random
 
+import primitives
 from util import makeDataClass, prettyString
 
 
@@ -11,6 +12,8 @@ class DistrValue(object):
   Superclass for things that can be passed to or returned from a distribution function.
   """
 
+  __slots__ = ()
+
   @staticmethod
   def fromJSON(jsonObj):
     """
@@ -34,9 +37,11 @@ class LiteralRef(DistrValue):
   ref field, which identifies which object it points to.
   """
 
+  __slots__ = ('ref', '_hash')
+
   def __init__(self, ref):
     assert isinstance(ref, int)
-    self.ref = ref
+    self.initFields(ref)
 
   def prettyString(self):
     return '@%s' % self.ref
@@ -53,16 +58,18 @@ class LiteralRef(DistrValue):
     assert isinstance(res, LiteralRef)
     return res
 
-makeDataClass(LiteralRef)
+makeDataClass(LiteralRef, frozen=True)
 
 class LocalVariable(DistrValue):
   """
   A reference to a variable assigned from some call.
   """
 
+  __slots__ = ('name', '_hash')
+
   def __init__(self, name):
     assert isinstance(name, str)
-    self.name = name
+    self.initFields(name)
 
   def prettyString(self):
     return '$%s' % self.name
@@ -79,7 +86,7 @@ class LocalVariable(DistrValue):
     assert isinstance(res, LocalVariable)
     return res
 
-makeDataClass(LocalVariable)
+makeDataClass(LocalVariable, frozen=True)
 
 
 class CallRef(object):
@@ -115,12 +122,13 @@ class DistrCall(object):
   by DistrValues).
   """
 
+  __slots__ = ('function', 'parameters', '_hash')
+
   def __init__(self, function, parameters):
     assert isinstance(function, str)
     parameters = tuple(parameters)
     assert all(isinstance(p, DistrValue) for p in parameters)
-    self.function = function
-    self.parameters = parameters
+    self.initFields(function, parameters)
 
   def prettyString(self):
     return ' '.join(map(str, [self.function] + list(self.parameters)))
@@ -133,7 +141,7 @@ class DistrCall(object):
             'parameters': [p.toJSON() for p in self.parameters]}
 
   def isPrimitive(self):
-    return self.function == 'bernouli'
+    return primitives.isPrimitive(self.function)
 
   @staticmethod
   def fromJSON(jsonObj):
@@ -143,16 +151,17 @@ class DistrCall(object):
     )
 
 
-makeDataClass(DistrCall)
+makeDataClass(DistrCall, frozen=True)
 
 class DistrCallAssignment(object):
 
+  __slots__ = ('call', 'variables', '_hash')
+
   def __init__(self, call, variables):
     assert isinstance(call, DistrCall)
     variables = tuple(variables)
     assert all(isinstance(v, str) for v in variables)
-    self.call = call
-    self.variables = variables
+    self.initFields(call, variables)
 
   def getData(self):
     return (self.call, self.variables)
@@ -171,7 +180,7 @@ class DistrCallAssignment(object):
       jsonObj['variables']
     )
 
-makeDataClass(DistrCallAssignment)
+makeDataClass(DistrCallAssignment, frozen=True)
 
 class Distribution(object):
   """
@@ -185,6 +194,8 @@ class Distribution(object):
     Distribution.assertLegalDistributionData(assignments, result)
     self.assignments = assignments
     self.result = result
+    # filled in lazily by algprob.compileDistribution
+    self.plan = None
 
   @staticmethod
   def assertLegalDistributionData(assignments, result):
@@ -225,8 +236,8 @@ class Distribution(object):
 
   @staticmethod
   def fromJSON(jsonObj):
-    return DistrCall(
-      [DistrCall.fromJSON(a) for a in jsonObj['assignments']],
+    return Distribution(
+      [DistrCallAssignment.fromJSON(a) for a in jsonObj['assignments']],
       [DistrValue.fromJSON(r) for r in jsonObj['result']]
     )
 
@@ -0,0 +1,263 @@
+import heapq
+import itertools
+
+import numpy as np
+
+from distribution import DistrCall
+from exact import ExactEngine, OutcomeTable, SupportBudgetExceeded
+from util import sumByLogs
+
+# np.einsum's sublist format numbers axes below this
+MAX_EINSUM_AXES = 52
+
+class Factor(object):
+  """
+  A non-negative function of some discrete variables, stored in log space:
+  logValues has one axis per variable, in the order of variables.
+  """
+
+  def __init__(self, variables, logValues):
+    assert len(variables) == logValues.ndim
+    self.variables = tuple(variables)
+    self.logValues = logValues
+
+def contract(factors, keep, sizes):
+  """
+  Multiplies factors together and sums out every variable not in keep.
+  Returns the resulting Factor, over the variables of keep in order.
+
+  Each factor is exponentiated relative to its maximum, so the contraction
+  is a single np.einsum over ordinary arrays.
+  """
+  variables = sorted(set(v for f in factors for v in f.variables) | set(keep))
+  if len(variables) > MAX_EINSUM_AXES:
+    raise SupportBudgetExceeded(
+      "eliminating needs a factor over " + str(len(variables)) + " variables")
+  axis = dict((v, i) for i, v in enumerate(variables))
+  operands = []
+  shift = 0.0
+  for f in factors:
+    fmax = np.max(f.logValues) if f.logValues.size else -np.inf
+    if fmax == -np.inf:
+      return Factor(keep, np.full([sizes[v] for v in keep], -np.inf))
+    shift += fmax
+    operands.append(np.exp(f.logValues - fmax))
+    operands.append([axis[v] for v in f.variables])
+  if not factors:
+    return Factor(keep, np.zeros([sizes[v] for v in keep]))
+  operands.append([axis[v] for v in keep])
+  with np.errstate(divide='ignore'):
+    logValues = np.log(np.einsum(*operands, optimize=len(factors) > 2)) + shift
+  return Factor(keep, np.asarray(logValues))
+
+def minFillOrder(factors, eliminate, sizes):
+  """
+  Orders the variables of eliminate greedily, each time picking the one whose
+  elimination adds the fewest edges to the interaction graph (ties broken by
+  the size of the factor it creates).
+  """
+  neighbors = dict((v, set()) for f in factors for v in f.variables)
+  for f in factors:
+    for v in f.variables:
+      neighbors[v].update(f.variables)
+      neighbors[v].discard(v)
+  def cost(v):
+    adjacent = list(neighbors[v])
+    fill = sum(1 for a, b in itertools.combinations(adjacent, 2)
+               if b not in neighbors[a])
+    size = 1
+    for a in adjacent:
+      size *= sizes[a]
+    return (fill, size, v)
+  remaining = set(eliminate)
+  costs = dict((v, cost(v)) for v in remaining)
+  heap = list(costs.values())
+  heapq.heapify(heap)
+  order = []
+  while remaining:
+    c = heapq.heappop(heap)
+    v = c[2]
+    if v not in remaining or costs[v] != c:
+      continue
+    adjacent = neighbors.pop(v)
+    for a in adjacent:
+      neighbors[a].discard(v)
+      neighbors[a].update(adjacent - set([a]))
+    remaining.discard(v)
+    order.append(v)
+    # only the costs of variables within two steps of v can change
+    affected = set(adjacent)
+    for a in adjacent:
+      affected.update(neighbors[a])
+    for a in affected & remaining:
+      costs[a] = cost(a)
+      heapq.heappush(heap, costs[a])
+  return order
+
+def eliminateAll(factors, keep, sizes):
+  """
+  Sums every variable not in keep out of the product of factors, in min-fill
+  order.  Returns a Factor over keep.
+  """
+  keep = tuple(keep)
+  eliminate = set(v for f in factors for v in f.variables) - set(keep)
+  factors = list(factors)
+  for v in minFillOrder(factors, eliminate, sizes):
+    touching = [f for f in factors if v in f.variables]
+    factors = [f for f in factors if v not in f.variables]
+    rest = sorted(set(u for f in touching for u in f.variables) - set([v]))
+    factors.append(contract(touching, rest, sizes))
+  return contract(factors, keep, sizes)
+
+
+class EliminationEngine(object):
+  """
+  Exact inference by variable elimination.  The assignments of a call's
+  Distribution become factors: each assignment is one variable (the tuple of
+  values it assigns), with a conditional probability table given the
+  assignments its parameters refer to.  The tables of the calls themselves
+  come from an ExactEngine, so they are memoized as there.
+
+  Unlike enumeration, the cost depends on the treewidth of the dependencies
+  between assignments rather than on the number of joint outcomes.
+  maxSupport bounds the size of each conditional probability table.
+  """
+
+  def __init__(self, model, maxSupport=1 << 16, engine=None):
+    self.engine = engine if engine is not None else ExactEngine(model, maxSupport)
+    self.maxSupport = maxSupport
+
+  def compile(self, function, params, variables=None):
+    """
+    Turns the distribution of a call into factors, for a query on the given
+    variables (or the result, if variables is None); assignments the query
+    doesn't depend on sum to one, so they are left out.  Returns a
+    CompiledQuery.
+    """
+    plan, constants = self.engine.getPlan(function, params)
+    stepOf = {}
+    slotOf = {}
+    for i, step in enumerate(plan.steps):
+      for j, (v, o) in enumerate(zip(step.variables, step.outputs)):
+        stepOf[o] = (i, j)
+        slotOf[v] = o
+    if variables is None:
+      targets = plan.result
+    else:
+      targets = tuple(slotOf[v] for v in variables)
+    keep = sorted(set(stepOf[t][0] for t in targets if t.__class__ is int))
+    needed = set(keep)
+    for i in reversed(range(len(plan.steps))):
+      if i in needed:
+        needed.update(stepOf[p][0] for p in plan.steps[i].params
+                      if p.__class__ is int)
+
+    domains = [None] * len(plan.steps)
+    factors = []
+    for i, step in enumerate(plan.steps):
+      if i not in needed:
+        continue
+      parents = sorted(set(stepOf[p][0] for p in step.params if p.__class__ is int))
+      shape = [len(domains[j]) for j in parents]
+      cells = 1
+      for size in shape:
+        cells *= size
+      if cells > self.maxSupport:
+        raise SupportBudgetExceeded(
+          "the table of " + step.function + " in " + function + " needs " +
+          str(cells) + " cells")
+      domain = []
+      index = {}
+      cellIndices = []
+      cellLogProbs = []
+      for combo in itertools.product(*[range(size) for size in shape]):
+        assignment = dict(zip(parents, combo))
+        def resolve(p):
+          if p.__class__ is int:
+            j, k = stepOf[p]
+            return domains[j][assignment[j]][k]
+          return constants[p]
+        table = self.engine.getTable(
+          step.function, tuple(resolve(p) for p in step.params))
+        for outcome, logProb in table.logProbs.items():
+          if outcome not in index:
+            index[outcome] = len(domain)
+            domain.append(outcome)
+          cellIndices.append(combo + (index[outcome],))
+          cellLogProbs.append(logProb)
+      domains[i] = domain
+      logValues = np.full(shape + [len(domain)], -np.inf)
+      if cellIndices:
+        logValues[tuple(np.array(cellIndices).T)] = cellLogProbs
+      factors.append(Factor(tuple(parents) + (i,), logValues))
+    return CompiledQuery(targets, keep, constants, stepOf, factors, domains)
+
+  def eliminateCall(self, call):
+    """
+    Returns the OutcomeTable of call's result.  Like sample, consumes one
+    reference per LiteralRef in the call's parameters.
+    """
+    return self.query(call, None)
+
+  def query(self, call, variables=None):
+    """
+    Returns the joint OutcomeTable of the given variables of call's
+    Distribution (names, as in DistrCallAssignment.variables), or of its
+    result if variables is None.  Consumes the call's references.
+    """
+    assert isinstance(call, DistrCall)
+    engine = self.engine
+    params = tuple(map(engine.keyOf, call.parameters))
+    for param in call.parameters:
+      engine.model.modifyReferenceCount(param, -1)
+    compiled = self.compile(call.function, params, variables)
+    return compiled.solve()
+
+
+class CompiledQuery(object):
+  """
+  The factors of a query on one call (see EliminationEngine.compile).  keep
+  lists the assignments the targets (slots or constants) are read from, and
+  domains[i] the outcomes of assignment i, indexing the axis of its factor.
+  """
+
+  def __init__(self, targets, keep, constants, stepOf, factors, domains):
+    self.targets = targets
+    self.keep = keep
+    self.constants = constants
+    self.stepOf = stepOf
+    self.factors = factors
+    self.domains = domains
+
+  def solve(self):
+    """
+    Eliminates every other assignment and returns the OutcomeTable of the
+    targets.
+    """
+    domains = self.domains
+    sizes = dict((i, len(domain)) for i, domain in enumerate(domains)
+                 if domain is not None)
+    joint = eliminateAll(self.factors, self.keep, sizes)
+    grouped = {}
+    for combo in itertools.product(*[range(sizes[i]) for i in self.keep]):
+      logProb = joint.logValues[combo]
+      if logProb == -np.inf:
+        continue
+      assignment = dict(zip(self.keep, combo))
+      def resolve(t):
+        if t.__class__ is int:
+          j, k = self.stepOf[t]
+          return domains[j][assignment[j]][k]
+        return self.constants[t]
+      outcome = tuple(resolve(t) for t in self.targets)
+      grouped.setdefault(outcome, []).append(float(logProb))
+    return OutcomeTable(dict((outcome, sumByLogs(logProbs))
+                             for outcome, logProbs in grouped.items()))
+
+
+def eliminateCall(model, call, maxSupport=1 << 16):
+  """
+  Returns the exact OutcomeTable of call by variable elimination, consuming
+  the call's references like sample.sample.
+  """
+  return EliminationEngine(model, maxSupport).eliminateCall(call)
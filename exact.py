@@ -0,0 +1,223 @@
+import json
+import math
+
+from distribution import DistrCall, LiteralRef
+from model import Model
+from util import negInfinity, sumByLogs
+
+import algprob
+import primitives
+
+def valueKey(value):
+  """
+  The key of a JSON value in an OutcomeTable: its canonical JSON text.  Two
+  values have the same key iff. they are equal in the sense of Model.isEqual.
+  """
+  return json.dumps(value, sort_keys=True)
+
+
+class SupportBudgetExceeded(Exception):
+  """
+  Raised when exact enumeration would need more outcomes (or intermediate
+  states) than the engine's maxSupport.
+  """
+  pass
+
+
+class OutcomeTable(object):
+  """
+  The exact distribution of a call: maps each outcome (a tuple with one key
+  per result value, see valueKey) to its log-probability.
+  """
+
+  def __init__(self, logProbs):
+    self.logProbs = logProbs
+
+  def __len__(self):
+    return len(self.logProbs)
+
+  def items(self):
+    """
+    Yields (values, logProb) pairs, where values is a tuple of JSON values.
+    """
+    for outcome, logProb in self.logProbs.items():
+      yield tuple(json.loads(key) for key in outcome), logProb
+
+  def logProbability(self, *values):
+    return self.logProbs.get(tuple(map(valueKey, values)), negInfinity)
+
+  def probability(self, *values):
+    return math.exp(self.logProbability(*values))
+
+  def marginal(self, index):
+    """
+    The distribution of the index'th result value alone.
+    """
+    groups = {}
+    for outcome, logProb in self.logProbs.items():
+      groups.setdefault((outcome[index],), []).append(logProb)
+    return OutcomeTable(dict((outcome, sumByLogs(logProbs))
+                             for outcome, logProbs in groups.items()))
+
+  def totalLogProbability(self):
+    return sumByLogs(list(self.logProbs.values()))
+
+  def prettyString(self):
+    return '{' + ', '.join(
+      '(' + ', '.join(outcome) + '): ' + str(math.exp(logProb))
+      for outcome, logProb in sorted(self.logProbs.items())) + '}'
+
+
+class ExactEngine(object):
+  """
+  Exact inference by enumeration, for models whose calls have finite
+  support.  The OutcomeTable of each call (identified by its function and the
+  JSON values of its parameters) is computed once and memoized.
+
+  The engine holds no references: parameters are passed to the model with
+  JSONToRef, and the references in each distribution are released once its
+  constants have been read.  Recursive calls (a call that needs its own
+  table) cannot be enumerated and raise an Exception.
+  """
+
+  def __init__(self, model, maxSupport=1 << 16):
+    assert isinstance(model, Model)
+    self.model = model
+    self.maxSupport = maxSupport
+    self.tables = {}
+    self.inProgress = set()
+    self.values = {}
+
+  def keyOf(self, ref):
+    return valueKey(self.model.refToJSON(ref))
+
+  def valueOf(self, key):
+    value = self.values.get(key)
+    if value is None:
+      value = self.values[key] = json.loads(key)
+    return value
+
+  def logProbability(self, function, params, result):
+    """
+    The log-probability that the call of function on params (keys) gives
+    result (a tuple of keys).  Primitives are scored directly, so this works
+    for continuous ones too (giving a log-density).
+    """
+    primitive = primitives.getPrimitive(function)
+    if primitive is not None:
+      assert len(result) == 1
+      return primitive.logProb([self.valueOf(p) for p in params],
+                               self.valueOf(result[0]))
+    return self.getTable(function, params).logProbs.get(result, negInfinity)
+
+  def enumerateCall(self, call):
+    """
+    Returns the OutcomeTable of call.  Like sample, consumes one reference per
+    LiteralRef in the call's parameters.
+    """
+    assert isinstance(call, DistrCall)
+    params = tuple(map(self.keyOf, call.parameters))
+    for param in call.parameters:
+      self.model.modifyReferenceCount(param, -1)
+    return self.getTable(call.function, params)
+
+  def getTable(self, function, params):
+    key = (function, params)
+    table = self.tables.get(key)
+    if table is not None:
+      return table
+    if key in self.inProgress:
+      raise Exception("cannot enumerate recursive call to " + function)
+    self.inProgress.add(key)
+    try:
+      primitive = primitives.getPrimitive(function)
+      if primitive is not None:
+        table = self.primitiveTable(primitive, params)
+      else:
+        table = self.distributionTable(function, params)
+    finally:
+      self.inProgress.discard(key)
+    self.tables[key] = table
+    return table
+
+  def primitiveTable(self, primitive, params):
+    support = primitive.support([self.valueOf(p) for p in params])
+    if support is None:
+      raise Exception("cannot enumerate " + primitive.name +
+                      ", which has infinite support")
+    if len(support) > self.maxSupport:
+      raise SupportBudgetExceeded(
+        primitive.name + " has more than " + str(self.maxSupport) + " outcomes")
+    return OutcomeTable(dict(((valueKey(value),), logProb)
+                             for value, logProb in support))
+
+  def getPlan(self, function, params):
+    """
+    Gets the distribution of a call from the model.  Returns its plan and a
+    dict mapping each LiteralRef constant in it to its key; the references
+    themselves have been released.
+    """
+    model = self.model
+    call = DistrCall(function, [model.JSONToRef(self.valueOf(p)) for p in params])
+    distr = model.getDistribution(call).distribution
+    plan = algprob.compileDistribution(distr)
+    constants = {}
+    for ref in algprob.distributionLiteralRefs(distr):
+      if ref not in constants:
+        constants[ref] = self.keyOf(ref)
+      model.modifyReferenceCount(ref, -1)
+    return plan, constants
+
+  def distributionTable(self, function, params):
+    plan, constants = self.getPlan(function, params)
+    def resolve(slots, p):
+      return slots[p] if p.__class__ is int else constants[p]
+
+    # the last step using each slot; a slot is dropped from the state after
+    # it, so states that differ only in dead slots are merged
+    lastUse = [len(plan.steps)] * plan.slotCount
+    for i, step in enumerate(plan.steps):
+      for o in step.outputs:
+        lastUse[o] = i
+    for i, step in enumerate(plan.steps):
+      for p in step.params:
+        if p.__class__ is int:
+          lastUse[p] = i
+    for r in plan.result:
+      if r.__class__ is int:
+        lastUse[r] = len(plan.steps)
+
+    states = {tuple(plan.newSlots()): 0.0}
+    for i, step in enumerate(plan.steps):
+      dead = [s for s in range(plan.slotCount) if lastUse[s] == i]
+      grouped = {}
+      for slots, logProb in states.items():
+        table = self.getTable(
+          step.function, tuple(resolve(slots, p) for p in step.params))
+        for outcome, outcomeLogProb in table.logProbs.items():
+          newSlots = list(slots)
+          plan.setOutputs(newSlots, step, outcome)
+          for s in dead:
+            newSlots[s] = None
+          grouped.setdefault(tuple(newSlots), []).append(logProb + outcomeLogProb)
+        if len(grouped) > self.maxSupport:
+          raise SupportBudgetExceeded(
+            "enumerating " + function + " needs more than " +
+            str(self.maxSupport) + " states")
+      states = dict((slots, sumByLogs(logProbs))
+                    for slots, logProbs in grouped.items())
+
+    grouped = {}
+    for slots, logProb in states.items():
+      outcome = tuple(resolve(slots, r) for r in plan.result)
+      grouped.setdefault(outcome, []).append(logProb)
+    return OutcomeTable(dict((outcome, sumByLogs(logProbs))
+                             for outcome, logProbs in grouped.items()))
+
+
+def enumerateCall(model, call, maxSupport=1 << 16):
+  """
+  Returns the exact OutcomeTable of call, consuming the call's references
+  like sample.sample.
+  """
+  return ExactEngine(model, maxSupport).enumerateCall(call)
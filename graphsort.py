@@ -15,33 +15,46 @@ def strongly_connected_components(graph):
 
         graph should be a dictionary mapping node names to
         lists of successor nodes.
+
+        The search uses an explicit stack rather than recursion, so it
+        works on arbitrarily deep graphs.
         """
 
     result = [ ]
     stack = [ ]
     low = { }
+    num = { }
+    stack_pos = { }
+    finished = len(graph)
 
-    def visit(node):
-        if node in low: return
-
-        num = len(low)
-        low[node] = num
-        stack_pos = len(stack)
+    def start(node):
+        num[node] = low[node] = len(low)
+        stack_pos[node] = len(stack)
         stack.append(node)
-
-        for successor in graph[node]:
-            visit(successor)
-            low[node] = min(low[node], low[successor])
-
-        if num == low[node]:
-            component = tuple(stack[stack_pos:])
-            del stack[stack_pos:]
-            result.append(component)
-        for item in component:
-            low[item] = len(graph)
-
-    for node in graph:
-        visit(node)
+        return node, iter(graph[node])
+
+    for root in graph:
+        if root in low: continue
+
+        work = [ start(root) ]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in low:
+                    work.append(start(successor))
+                    break
+                low[node] = min(low[node], low[successor])
+            else:
+                work.pop()
+                if num[node] == low[node]:
+                    component = tuple(stack[stack_pos[node]:])
+                    del stack[stack_pos[node]:]
+                    result.append(component)
+                    for item in component:
+                        low[item] = finished
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
 
     return result
 
@@ -75,14 +88,16 @@ def robust_topological_sort(graph):
 
     components = strongly_connected_components(graph)
 
+    # work with component numbers, since hashing or comparing the
+    # component tuples themselves costs time linear in their size
     node_component = { }
-    for component in components:
+    for i, component in enumerate(components):
         for node in component:
-            node_component[node] = component
+            node_component[node] = i
 
     component_graph = { }
-    for component in components:
-        component_graph[component] = [ ]
+    for i in range(len(components)):
+        component_graph[i] = [ ]
 
     for node in graph:
         node_c = node_component[node]
@@ -91,7 +106,123 @@ def robust_topological_sort(graph):
             if node_c != successor_c:
                 component_graph[node_c].append(successor_c)
 
-    return topological_sort(component_graph)
+    return [ components[i] for i in topological_sort(component_graph) ]
+
+
+class IncrementalTopologicalSort(object):
+    """ Maintains the strongly connected components of a graph, and a
+        topological order of them, as nodes and edges are added.
+
+        Adding an edge that agrees with the current order costs O(1).
+        Otherwise only the components whose position lies between the
+        edge's endpoints are searched and reordered (the algorithm of
+        Pearce and Kelly), and any cycle the edge closes is merged into
+        a single component.
+        """
+
+    def __init__(self, graph=None):
+        self.component = { }    # node -> component id
+        self.members = { }      # component id -> list of nodes
+        self.succ = { }         # component id -> set of component ids
+        self.pred = { }         # component id -> set of component ids
+        self.ord = { }          # component id -> position in the order
+        self.next_id = 0
+        self.next_ord = 0
+        if graph is not None:
+            for node in graph:
+                self.add_node(node)
+            for node in graph:
+                for successor in graph[node]:
+                    self.add_edge(node, successor)
+
+    def add_node(self, node):
+        if node in self.component: return
+        c = self.next_id
+        self.next_id += 1
+        self.component[node] = c
+        self.members[c] = [ node ]
+        self.succ[c] = set()
+        self.pred[c] = set()
+        self.ord[c] = self.next_ord
+        self.next_ord += 1
+
+    def add_edge(self, node, successor):
+        self.add_node(node)
+        self.add_node(successor)
+        cu = self.component[node]
+        cv = self.component[successor]
+        if cu == cv or cv in self.succ[cu]: return
+
+        lower = self.ord[cv]
+        upper = self.ord[cu]
+        if upper > lower:
+            self.reorder(cu, cv, lower, upper)
+            cu = self.component[node]
+            cv = self.component[successor]
+            if cu == cv: return
+        self.succ[cu].add(cv)
+        self.pred[cv].add(cu)
+
+    def search(self, start, edges, within):
+        seen = set([ start ])
+        todo = [ start ]
+        while todo:
+            c = todo.pop()
+            for d in edges[c]:
+                if d not in seen and within(self.ord[d]):
+                    seen.add(d)
+                    todo.append(d)
+        return seen
+
+    def reorder(self, cu, cv, lower, upper):
+        """ Restores the order after an edge cu -> cv with
+            ord[cv] = lower < ord[cu] = upper. """
+        forward = self.search(cv, self.succ, lambda o: o <= upper)
+        backward = self.search(cu, self.pred, lambda o: o >= lower)
+        cycle = forward & backward
+        by_ord = lambda c: self.ord[c]
+        positions = sorted(self.ord[c] for c in forward | backward)
+        # the backward set takes the lowest positions and the forward set
+        # the highest, so no node moves past a node outside the region
+        before = sorted(backward - cycle, key=by_ord)
+        after = sorted(forward - cycle, key=by_ord)
+        for c, position in zip(before, positions):
+            self.ord[c] = position
+        for c, position in zip(after, positions[len(positions) - len(after):]):
+            self.ord[c] = position
+        if cycle:
+            self.ord[self.merge(cycle)] = positions[len(before)]
+
+    def merge(self, components):
+        """ Merges components (which form a cycle) into one, returning
+            its id. """
+        target = max(components, key=lambda c: len(self.members[c]))
+        for c in components:
+            if c == target: continue
+            for node in self.members[c]:
+                self.component[node] = target
+            self.members[target].extend(self.members.pop(c))
+            for d in self.succ.pop(c):
+                self.pred[d].discard(c)
+                self.pred[d].add(target)
+                self.succ[target].add(d)
+            for d in self.pred.pop(c):
+                self.succ[d].discard(c)
+                self.succ[d].add(target)
+                self.pred[target].add(d)
+            del self.ord[c]
+        self.succ[target] -= components
+        self.pred[target] -= components
+        return target
+
+    def components(self):
+        """ The strongly connected components as tuples of nodes, in
+            topological order (as returned by robust_topological_sort). """
+        order = sorted(self.members, key=lambda c: self.ord[c])
+        return [ tuple(self.members[c]) for c in order ]
+
+    def same_component(self, a, b):
+        return self.component[a] == self.component[b]
 
 
 if __name__ == '__main__':
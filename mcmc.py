@@ -0,0 +1,281 @@
+# Single-site Metropolis-Hastings over execution traces.
+
+import math
+import random
+
+from distribution import DistrCall
+from exact import ExactEngine, valueKey
+from model import Model
+from util import negInfinity
+from weighted import evidenceTable
+
+import primitives
+
+TRUE = valueKey(True)
+FALSE = valueKey(False)
+
+class TraceNode(object):
+  """
+  One call in an execution trace.  function and params (value keys, see
+  exact.valueKey) identify the call, and result holds the keys of its
+  result.  kind is:
+
+    'choice': a call of a primitive; logProb is the log-probability (or
+      log-density) of its result.
+    'observed': a call clamped to the result of an evidence label; logProb is
+      the log-likelihood of that result.
+    'call': any other call, with the plan and constants of its Distribution,
+      the keys in its slots and one child node per step.
+
+  choices and logLikelihood total the choices and the log-likelihood of the
+  evidence over the subtree.  Nodes are never modified, so a proposal shares
+  every subtree it doesn't change with the current trace.
+  """
+
+  __slots__ = ('function', 'params', 'kind', 'result', 'logProb', 'plan',
+               'constants', 'slots', 'children', 'choices', 'logLikelihood')
+
+  def __init__(self, function, params, kind, result, logProb=0.0, plan=None,
+               constants=None, slots=None, children=()):
+    self.function = function
+    self.params = params
+    self.kind = kind
+    self.result = result
+    self.logProb = logProb
+    self.plan = plan
+    self.constants = constants
+    self.slots = slots
+    self.children = children
+    if kind == 'choice':
+      self.choices = 1
+      self.logLikelihood = 0.0
+    elif kind == 'observed':
+      self.choices = 0
+      self.logLikelihood = logProb
+    else:
+      self.choices = sum(c.choices for c in children)
+      self.logLikelihood = sum(c.logLikelihood for c in children)
+
+
+class Proposal(object):
+  """
+  Accumulates, while a proposal is built, the change in log-probability of
+  the choices kept from the current trace (rescored under their new
+  parameters).  Fresh choices and dropped ones cancel against the proposal
+  distribution, so they don't count.
+  """
+
+  def __init__(self):
+    self.reusedDelta = 0.0
+
+
+class MHSampler(object):
+  """
+  Samples a call conditioned on evidence by single-site Metropolis-Hastings.
+
+  The state is an execution trace of the call (see TraceNode).  A step picks
+  one choice (a call of a primitive) uniformly and changes it: a bernouli is
+  flipped, and any other primitive redrawn from its distribution.  Then only
+  the calls downstream of it whose parameters changed are re-executed: a
+  changed call keeps the children of the old one at the same step index
+  (rescoring kept choices), unchanged calls are shared, and Distributions
+  are memoized per call.  The proposal is accepted with probability
+  exp(log alpha), where
+
+    log alpha = (change in log-probability of the kept choices, including
+                 a flipped one) + (change in log-likelihood of the
+                 evidence) + log N - log N'
+
+  with N and N' the number of choices before and after.  (A redrawn choice's
+  change cancels against the probability of proposing it.)
+
+  Evidence is a list of ProbLabels, handled as in weighted.WeightedSampler:
+  calls matching one (by value) are clamped to its result, and their
+  probability (from ExactEngine.logProbability) is the likelihood.  The
+  call's references are consumed; the labels' stay with the caller.
+  """
+
+  def __init__(self, model, call, evidence=(), rng=random, engine=None,
+               maxInitTries=1000):
+    assert isinstance(model, Model)
+    assert isinstance(call, DistrCall)
+    self.model = model
+    self.rng = rng
+    self.engine = engine if engine is not None else ExactEngine(model)
+    self.plans = {}
+    self.observed = evidenceTable(self.engine, evidence)
+    self.function = call.function
+    self.params = tuple(map(self.engine.keyOf, call.parameters))
+    for p in call.parameters:
+      model.modifyReferenceCount(p, -1)
+    self.proposed = 0
+    self.accepted = 0
+    for i in range(maxInitTries):
+      self.trace = self.execute(self.function, self.params, None, Proposal())
+      if self.trace.logLikelihood != negInfinity:
+        break
+    else:
+      raise Exception("found no trace consistent with the evidence")
+
+  def getPlan(self, function, params):
+    key = (function, params)
+    res = self.plans.get(key)
+    if res is None:
+      res = self.plans[key] = self.engine.getPlan(function, params)
+    return res
+
+  def choiceLogProb(self, function, params, value):
+    return self.engine.logProbability(function, params, (value,))
+
+  def drawChoice(self, primitive, params):
+    value = primitive.sample([self.engine.valueOf(p) for p in params], self.rng)
+    return valueKey(value)
+
+  def execute(self, function, params, old, proposal):
+    """
+    Builds the node for a call, reusing what it can of old (the node at the
+    same address in the current trace, or None).
+    """
+    result = self.observed.get((function, params))
+    if result is not None:
+      return TraceNode(function, params, 'observed', result,
+                       self.engine.logProbability(function, params, result))
+    primitive = primitives.getPrimitive(function)
+    if primitive is not None:
+      if old is not None and old.kind == 'choice' and old.function == function:
+        value = old.result[0]
+        logProb = self.choiceLogProb(function, params, value)
+        proposal.reusedDelta += logProb - old.logProb
+      else:
+        value = self.drawChoice(primitive, params)
+        logProb = self.choiceLogProb(function, params, value)
+      return TraceNode(function, params, 'choice', (value,), logProb)
+    if old is not None and (old.kind != 'call' or old.function != function):
+      old = None
+    plan, constants = self.getPlan(function, params)
+    slots = plan.newSlots()
+    children = []
+    oldChildren = old.children if old is not None else ()
+    for i, step in enumerate(plan.steps):
+      oldChild = oldChildren[i] if i < len(oldChildren) else None
+      children.append(self.executeStep(step, slots, constants, oldChild, proposal))
+    return self.makeCallNode(function, params, plan, constants, slots, children)
+
+  def executeStep(self, step, slots, constants, oldChild, proposal):
+    """
+    Runs one step of a Distribution, reusing oldChild outright if its call
+    is unchanged, and sets the step's outputs in slots.
+    """
+    params = tuple(slots[p] if p.__class__ is int else constants[p]
+                   for p in step.params)
+    if oldChild is not None and oldChild.function == step.function and \
+       oldChild.params == params:
+      child = oldChild
+    else:
+      if oldChild is not None and oldChild.function != step.function:
+        oldChild = None
+      child = self.execute(step.function, params, oldChild, proposal)
+    for o, r in zip(step.outputs, child.result):
+      slots[o] = r
+    return child
+
+  def makeCallNode(self, function, params, plan, constants, slots, children):
+    result = tuple(slots[r] if r.__class__ is int else constants[r]
+                   for r in plan.result)
+    return TraceNode(function, params, 'call', result, 0.0, plan, constants,
+                     slots, tuple(children))
+
+  def findChoice(self, index):
+    """
+    The path (a list of (node, step index) pairs from the root) to the
+    index'th choice of the trace, and the choice itself.
+    """
+    node = self.trace
+    path = []
+    while node.kind == 'call':
+      for i, child in enumerate(node.children):
+        if index < child.choices:
+          path.append((node, i))
+          node = child
+          break
+        index -= child.choices
+    return path, node
+
+  def propose(self):
+    """
+    Builds a proposal from the current trace.  Returns (trace, log alpha).
+    """
+    trace = self.trace
+    path, choice = self.findChoice(self.rng.randrange(trace.choices))
+    proposal = Proposal()
+    if choice.function == 'bernouli':
+      value = FALSE if choice.result[0] == TRUE else TRUE
+      logProb = self.choiceLogProb(choice.function, choice.params, value)
+      if logProb == negInfinity:
+        return None, negInfinity
+      proposal.reusedDelta += logProb - choice.logProb
+    else:
+      primitive = primitives.getPrimitive(choice.function)
+      value = self.drawChoice(primitive, choice.params)
+      logProb = self.choiceLogProb(choice.function, choice.params, value)
+    node = TraceNode(choice.function, choice.params, 'choice', (value,), logProb)
+    # rebuild the ancestors bottom-up; in each, the steps after the changed
+    # one are re-executed only if their parameters changed
+    for parent, index in reversed(path):
+      plan = parent.plan
+      slots = list(parent.slots)
+      children = list(parent.children)
+      children[index] = node
+      for o, r in zip(plan.steps[index].outputs, node.result):
+        slots[o] = r
+      for i in range(index + 1, len(plan.steps)):
+        children[i] = self.executeStep(plan.steps[i], slots, parent.constants,
+                                       parent.children[i], proposal)
+      node = self.makeCallNode(parent.function, parent.params, plan,
+                               parent.constants, slots, children)
+    if node.choices == 0:
+      return None, negInfinity
+    logAlpha = (proposal.reusedDelta +
+                node.logLikelihood - trace.logLikelihood +
+                math.log(trace.choices) - math.log(node.choices))
+    return node, logAlpha
+
+  def step(self):
+    """
+    Makes one Metropolis-Hastings step.  Returns whether the proposal was
+    accepted.  A trace without choices stays as it is.
+    """
+    if self.trace.choices == 0:
+      return False
+    self.proposed += 1
+    node, logAlpha = self.propose()
+    if node is None:
+      return False
+    if logAlpha >= 0 or self.rng.random() < math.exp(logAlpha):
+      self.trace = node
+      self.accepted += 1
+      return True
+    return False
+
+  def result(self):
+    """
+    The result of the current trace, as JSON values.
+    """
+    return tuple(self.engine.valueOf(r) for r in self.trace.result)
+
+  def run(self, n, burnIn=0, thin=1):
+    """
+    Makes burnIn steps, then n * thin more, returning the result after every
+    thin'th of them.
+    """
+    for i in range(burnIn):
+      self.step()
+    results = []
+    for i in range(n):
+      for j in range(thin):
+        self.step()
+      results.append(self.result())
+    return results
+
+  def acceptanceRate(self):
+    return self.accepted / self.proposed if self.proposed else 0.0
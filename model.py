@@ -1,5 +1,10 @@
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import json
+import threading
 
+import algprob
 import distribution
 from distribution import LiteralRef, DistrCall, Distribution
 from util import makeDataClass
@@ -80,19 +85,125 @@ class Model(object):
     """
     return json.dumps(self.refToJSON(aref)) == json.dumps(self.refToJSON(bref))
 
+class DistributionCache(object):
+  """
+  An LRU cache of DistrResults keyed by DistrCall, used by WrappedModel.
+
+  The cache holds its own reference to every LiteralRef in a cached call and
+  its distribution, and releases them when the entry is evicted.  At most
+  maxEntries entries are kept; if maxBytes is given, the total size of the
+  cached distributions (measured as JSON) is kept under it too.
+
+  The cache can be shared between threads.  Its lock is not held while the
+  model computes a distribution, so two threads missing on the same call both
+  compute it, and only the first result is kept.
+  """
+
+  def __init__(self, maxEntries=1024, maxBytes=None):
+    assert maxEntries is None or maxEntries > 0
+    self.lock = threading.RLock()
+    self.maxEntries = maxEntries
+    self.maxBytes = maxBytes
+    self.entries = OrderedDict()
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    with self.lock:
+      return len(self.entries)
+
+  @staticmethod
+  def modifyReferenceCounts(model, refs, delta):
+    for ref, count in Counter(refs).items():
+      model.modifyReferenceCount(ref, delta * count)
+
+  def getDistribution(self, model, call):
+    """
+    Returns model.getDistribution(call), from the cache if possible.  Follows
+    the reference counting contract of Model.getDistribution.
+    """
+    with self.lock:
+      entry = self.entries.get(call)
+      if entry is not None:
+        self.hits += 1
+        self.entries.move_to_end(call)
+        result = entry[0]
+        self.modifyReferenceCounts(model, call.parameters, -1)
+        self.modifyReferenceCounts(
+          model, algprob.distributionLiteralRefs(result.distribution), 1)
+        return result
+      self.misses += 1
+      # hold on to the parameters before the model consumes the caller's references
+      self.modifyReferenceCounts(model, call.parameters, 1)
+    result = model.getDistribution(call)
+    size = 0
+    if self.maxBytes is not None:
+      size = len(json.dumps(result.toJSON()))
+    with self.lock:
+      if call in self.entries:
+        # another thread cached it meanwhile
+        self.modifyReferenceCounts(model, call.parameters, -1)
+        return result
+      self.modifyReferenceCounts(
+        model, algprob.distributionLiteralRefs(result.distribution), 1)
+      self.entries[call] = (result, size)
+      self.bytes += size
+      self.evict(model)
+    return result
+
+  def evict(self, model, keep=None):
+    """
+    Evicts least recently used entries until the cache is within its limits,
+    or down to keep entries if given.
+    """
+    def overLimit():
+      if keep is not None:
+        return len(self.entries) > keep
+      if self.maxEntries is not None and len(self.entries) > self.maxEntries:
+        return True
+      return self.maxBytes is not None and self.bytes > self.maxBytes
+    with self.lock:
+      while len(self.entries) > 0 and overLimit():
+        call, (result, size) = self.entries.popitem(last=False)
+        self.bytes -= size
+        self.evictions += 1
+        self.modifyReferenceCounts(model, call.parameters, -1)
+        self.modifyReferenceCounts(
+          model, algprob.distributionLiteralRefs(result.distribution), -1)
+
+  def clear(self, model):
+    self.evict(model, keep=0)
+
+  def getStats(self):
+    with self.lock:
+      return {'entries': len(self.entries), 'bytes': self.bytes,
+              'hits': self.hits, 'misses': self.misses,
+              'evictions': self.evictions}
+
 class WrappedModel(Model):
   """
   An easier to use, safer, and more efficient wrapper around a model.
   Mostly behaves exactly the same as the original.
+
+  If a DistributionCache is given, getDistribution results are memoized in it
+  (getDistribution is deterministic, so this is unobservable apart from
+  timing).
   """
 
-  def __init__(self, wrapped):
+  def __init__(self, wrapped, cache=None):
+    assert cache is None or isinstance(cache, DistributionCache)
     self.wrapped = wrapped
+    self.cache = cache
 
   def getDistribution(self, call):
     assert isinstance(call, DistrCall)
     assert all(isinstance(p, LiteralRef) for p in call.parameters)
-    result = self.wrapped.getDistribution(call)
+    if self.cache is not None:
+      result = self.cache.getDistribution(self.wrapped, call)
+    else:
+      result = self.wrapped.getDistribution(call)
     assert isinstance(result, DistrResult)
     return result
 
@@ -120,7 +231,60 @@ class WrappedModel(Model):
     return self.wrapped.isEqual(aref, bref)
 
 
+class ThreadPoolModel(Model):
+  """
+  A front end that runs getDistribution calls of a thread-safe model (such
+  as a PythonFunctionModel) on a thread pool, so that distribution functions
+  waiting on I/O overlap.  Submit calls with getDistributionAsync or
+  getDistributions; the other methods go straight to the wrapped model.
+  """
+
+  def __init__(self, wrapped, workers=8, executor=None):
+    self.wrapped = wrapped
+    if executor is None:
+      executor = ThreadPoolExecutor(max_workers=workers)
+    self.executor = executor
+
+  def getDistributionAsync(self, call):
+    """
+    Starts getDistribution(call) on the pool and returns a Future of its
+    DistrResult.  The call's references are consumed by the model when the
+    call runs.
+    """
+    assert isinstance(call, DistrCall)
+    # run in a copy of the caller's context, so that refs the call creates
+    # are tracked by the caller's open arenas (see defmodel.Arena)
+    context = contextvars.copy_context()
+    return self.executor.submit(context.run, self.wrapped.getDistribution, call)
+
+  def getDistributions(self, calls):
+    """
+    Runs getDistribution on all of calls concurrently and returns their
+    DistrResults in order.
+    """
+    futures = [self.getDistributionAsync(call) for call in calls]
+    return [future.result() for future in futures]
+
+  def getDistribution(self, call):
+    return self.getDistributionAsync(call).result()
+
+  def modifyReferenceCount(self, ref, delta):
+    self.wrapped.modifyReferenceCount(ref, delta)
+
+  def JSONToRef(self, jsonObj):
+    return self.wrapped.JSONToRef(jsonObj)
+
+  def refToJSON(self, ref):
+    return self.wrapped.refToJSON(ref)
 
+  def isEqual(self, aref, bref):
+    return self.wrapped.isEqual(aref, bref)
 
+  def close(self):
+    self.executor.shutdown()
 
+  def __enter__(self):
+    return self
 
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
@@ -2,65 +2,287 @@ import json
 import socket
 import time
 
-from distribution import Distribution, LiteralRef
-from model import DistributionResult, Model
+from collections import Counter
+
+import algprob
+from distribution import DistrCall, Distribution, LiteralRef
+from model import DistrResult, Model
+import wireformat
+from wireformat import fromWire
+
+
+class RemoteModelError(Exception):
+  """
+  Raised for a query that failed on the server, with the server's message.
+  """
+  pass
 
 
 class SocketModelClient(Model):
   """
   A model that defers to an external model communicating over a socket to answer calls.
+
+  Queries are tagged with request ids, so several can be in flight at once
+  (see sendQuery, receiveReply and queryMany).  Queries can also be queued
+  with queueQuery and sent together as a single batch by flush; queued
+  queries are always sent before any later query.  If deferReferenceCounts
+  is set, modifyReferenceCount only queues its change.
+
+  If binary is set, the client asks the server to switch to the binary
+  format of wireformat, with length-prefixed frames; servers that don't
+  support it keep using JSON lines.
+
+  If prefetchDepth is positive, getDistribution uses expandCall to fetch
+  the distributions of sub-calls prefetchDepth levels deep along with each
+  call, and answers later calls from them.
   """
 
-  BUFSIZE = 1024
+  BUFSIZE = 1 << 16
 
-  def __init__(self, sock):
+  def __init__(self, sock, deferReferenceCounts=False, binary=False,
+               prefetchDepth=0, prefetchCalls=256):
     self.socket = sock
+    self.deferReferenceCounts = deferReferenceCounts
+    self.buffer = bytearray()
+    # reused for reading binary frames
+    self.frameBuffer = bytearray(SocketModelClient.BUFSIZE)
+    self.outgoing = []
+    self.nextRequestId = 0
+    # replies that arrived before anyone asked for them
+    self.replies = {}
+    # request ids whose replies nobody will ask for
+    self.discarded = set()
+    self.queued = []
+    self.prefetchDepth = prefetchDepth
+    self.prefetchCalls = prefetchCalls
+    # maps DistrCalls to lists of [distrResult, remaining uses]
+    self.prefetched = {}
+    self.binary = False
+    if binary:
+      formats = {'formats': ['binary', 'json']}
+      self.binary = self.queryModel('negotiate', formats) == 'binary'
+
+  def receive(self):
+    resp = self.socket.recv(SocketModelClient.BUFSIZE)
+    if len(resp) == 0:
+      raise Exception("connection to model closed")
+    self.buffer += resp
+
+  def readLine(self):
+    start = 0
+    end = self.buffer.find(b'\n')
+    while end == -1:
+      start = len(self.buffer)
+      self.receive()
+      end = self.buffer.find(b'\n', start)
+    line = self.buffer[:end].decode('utf-8')
+    del self.buffer[:end + 1]
+    return line
+
+  def readExactly(self, n):
+    """
+    Reads exactly n bytes into the frame buffer, returning a memoryview of
+    them that is valid until the next read.
+    """
+    if len(self.frameBuffer) < n:
+      self.frameBuffer = bytearray(max(n, 2 * len(self.frameBuffer)))
+    view = memoryview(self.frameBuffer)[:n]
+    got = min(n, len(self.buffer))
+    view[:got] = self.buffer[:got]
+    del self.buffer[:got]
+    while got < n:
+      received = self.socket.recv_into(view[got:])
+      if received == 0:
+        raise Exception("connection to model closed")
+      got += received
+    return view
+
+  def readReply(self):
+    """
+    Reads the next reply, returning its request id and result.  The result
+    of a query that failed on the server is a RemoteModelError.
+    """
+    if self.binary:
+      header = self.readExactly(4)
+      length = wireformat.UINT32.unpack_from(header)[0]
+      reply = wireformat.decode(self.readExactly(length))
+      if len(reply) == 3:
+        return reply[0], RemoteModelError(reply[2])
+      return reply[0], reply[1]
+    line = self.readLine()
+    assert line.startswith('#') or line.startswith('!')
+    split = line.find(' ')
+    res = json.loads(line[split + 1 :])
+    if line.startswith('!'):
+      res = RemoteModelError(res)
+    return int(line[1 : split]), res
+
+  def encodeQuery(self, requestId, command, args):
+    if self.binary:
+      return wireformat.encodeFrame([requestId, command, args])
+    return ('#%d %s %s\n' % (requestId, command, json.dumps(args))).encode('utf-8')
+
+  def toWire(self, obj):
+    """
+    The form to send obj in: the object itself in the binary format, and its
+    JSON otherwise.
+    """
+    if self.binary:
+      return obj
+    return obj.toJSON()
 
   def rawQueryModel(self, queryString):
     """
     Sends a string to the external model, then returns the JSON that the model
     replies with.
     """
-    self.socket.sendAll(queryString)
-    data = ""
-    while True:
-      resp = self.socket.recv(SocketModel.BUFSIZE)
-      data += resp
-      if '\n' in resp:
-        break
-      time.sleep(0)
-    return json.loads(data)
+    assert not self.binary
+    self.sendOutgoing()
+    self.socket.sendall(queryString.encode('utf-8'))
+    return json.loads(self.readLine())
+
+  def sendOutgoing(self):
+    if len(self.outgoing) > 0:
+      self.socket.sendall(b''.join(self.outgoing))
+      self.outgoing = []
+
+  def sendQuery(self, command, args):
+    """
+    Sends a command and arguments without waiting for the reply.  Returns
+    the request id to pass to receiveReply.  (Queries are buffered until a
+    reply is waited for.)
+    """
+    self.flush(wait=False)
+    requestId = self.nextRequestId
+    self.nextRequestId += 1
+    self.outgoing.append(self.encodeQuery(requestId, command, args))
+    return requestId
+
+  def receiveReply(self, requestId):
+    """
+    Waits for and returns the JSON reply to the query with the given id, or
+    raises a RemoteModelError if it failed on the server.
+    """
+    self.sendOutgoing()
+    while requestId not in self.replies:
+      replyId, res = self.readReply()
+      if replyId in self.discarded:
+        self.discarded.remove(replyId)
+      else:
+        self.replies[replyId] = res
+    res = self.replies.pop(requestId)
+    if isinstance(res, RemoteModelError):
+      raise res
+    return res
 
   def queryModel(self, command, args):
     """
     Sends a command and arguments (as a single JSON object) to the external model, then
     returns the JSON that the external model replies with.
     """
-    query = command + ' ' + json.dumps(args) + '\n'
-    return self.rawQueryModel(query)
+    return self.receiveReply(self.sendQuery(command, args))
+
+  def queryMany(self, queries):
+    """
+    Pipelines a list of (command, args) queries, returning their results.
+    """
+    requestIds = [self.sendQuery(command, args) for command, args in queries]
+    return [self.receiveReply(i) for i in requestIds]
+
+  def queueQuery(self, command, args):
+    """
+    Queues a query to be sent in the next batch.
+    """
+    self.queued.append([command, args])
+
+  def flush(self, wait=True):
+    """
+    Sends all queued queries as one batch.  If wait is set, waits for and
+    returns the list of their results.
+    """
+    if len(self.queued) == 0:
+      return []
+    queued = self.queued
+    self.queued = []
+    requestId = self.nextRequestId
+    self.nextRequestId += 1
+    self.outgoing.append(self.encodeQuery(requestId, 'batch', queued))
+    if wait:
+      return self.receiveReply(requestId)
+    self.discarded.add(requestId)
+
+  def batch(self, queries):
+    """
+    Runs a list of (command, args) queries as one batch, returning their
+    results.
+    """
+    for command, args in queries:
+      self.queueQuery(command, args)
+    return self.flush()
+
+  def expandCall(self, call, maxDepth, maxCalls=256):
+    """
+    Gets the distribution of call, along with those of the sub-calls the
+    server can expand ahead of sampling (see modelserver.expandCall), in one
+    round trip.  The sub-calls' distributions are kept to answer later
+    getDistribution calls.
+    """
+    res = self.queryModel('expandCall', {
+      'call': self.toWire(call),
+      'maxDepth': maxDepth,
+      'maxCalls': maxCalls
+    })
+    for subcall, distrResult, uses in res['expanded']:
+      subcall = fromWire(subcall, DistrCall)
+      distrResult = fromWire(distrResult, DistrResult)
+      self.prefetched.setdefault(subcall, []).append([distrResult, uses])
+    return fromWire(res['result'], DistrResult)
 
   def getDistribution(self, call):
-    res = self.queryModel('getDistribution', call.toJSON())
-    return DistributionResult.fromJSON(res)
+    entries = self.prefetched.get(call)
+    if entries is not None:
+      entry = entries[-1]
+      entry[1] -= 1
+      if entry[1] == 0:
+        entries.pop()
+        if len(entries) == 0:
+          del self.prefetched[call]
+      # the server didn't consume the parameters, so release them here
+      for p in call.parameters:
+        self.queueQuery('modifyReferenceCount',
+                        {'ref': self.toWire(p), 'delta': -1})
+      return entry[0]
+    if self.prefetchDepth > 0:
+      return self.expandCall(call, self.prefetchDepth, self.prefetchCalls)
+    res = self.queryModel('getDistribution', self.toWire(call))
+    return fromWire(res, DistrResult)
+
+  def discardPrefetched(self):
+    """
+    Drops all unused prefetched distributions, releasing their references.
+    """
+    for entries in self.prefetched.values():
+      for distrResult, uses in entries:
+        refs = algprob.distributionLiteralRefs(distrResult.distribution)
+        for ref, count in Counter(refs).items():
+          self.queueQuery('modifyReferenceCount',
+                          {'ref': self.toWire(ref), 'delta': -uses * count})
+    self.prefetched = {}
+    self.flush()
 
   def modifyReferenceCount(self, ref, delta):
-    self.queryModel(
-      'modifyReferenceCount', {
-        'ref': ref.toJSON(),
-        'delta': delta
-      }
-    )
+    args = {'ref': self.toWire(ref), 'delta': delta}
+    if self.deferReferenceCounts:
+      self.queueQuery('modifyReferenceCount', args)
+    else:
+      self.queryModel('modifyReferenceCount', args)
 
   def JSONToRef(self, jsonObj):
     res = self.queryModel('JSONToRef', jsonObj)
-    return LiteralRef.fromJSON(res)
+    return fromWire(res, LiteralRef)
 
-  def writeJSON(self, ref):
-    return self.queryModel('writeJSON', ref.toJSON())
+  def refToJSON(self, ref):
+    return self.queryModel('refToJSON', self.toWire(ref))
 
   def isEqual(self, aref, bref):
-    return self.queryModel('isEqual', [aref.toJSON(), bref.toJSON()])
-
-
-
-
+    return self.queryModel('isEqual', [self.toWire(aref), self.toWire(bref)])
@@ -1,9 +1,133 @@
+
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import json
 import socket
 import time
+import traceback
 
 from distribution import Distribution, DistrCall, LiteralRef
-from model import Model
+from model import DistrResult, Model
+import algprob
+import wireformat
+from wireformat import fromWire, toJSONDefault
+
+
+def parseQuery(query):
+  """
+  Splits a query line into its request id, command and (parsed JSON)
+  arguments.  A query is either "command json", or "#id command json" for a
+  query whose reply should be tagged with the integer id; the request id is
+  None for the former.
+  """
+  requestId = None
+  if query.startswith('#'):
+    split = query.find(' ')
+    assert split != -1
+    requestId = int(query[1 : split])
+    query = query[split + 1 :]
+  split = query.find(' ')
+  assert split != -1
+  return requestId, query[0 : split], json.loads(query[split + 1 :])
+
+def formatReply(requestId, res):
+  """
+  Formats the reply line to a query with the given request id.
+  """
+  res = json.dumps(res, default=toJSONDefault)
+  if requestId is None:
+    return res + '\n'
+  return '#%d %s\n' % (requestId, res)
+
+def formatErrorReply(requestId, message):
+  """
+  Formats the reply line reporting that the query with the given request id
+  failed: "!id message", with the message as a JSON string.
+  """
+  return '!%d %s\n' % (requestId, json.dumps(message))
+
+def errorMessage(exc):
+  return '%s: %s' % (type(exc).__name__, exc)
+
+def getQueryResult(model, command, args):
+  """
+  Runs one command against the model, returning the result to reply with.
+  Arguments and results may be objects such as DistrCalls, rather than their
+  JSON (see wireformat.fromWire).
+
+  The batch command takes a list of [command, arguments] pairs, runs them in
+  order, and returns the list of their results.
+  """
+  if command == 'batch':
+    return [getQueryResult(model, c, a) for c, a in args]
+  if command == 'getDistribution':
+    return model.getDistribution(fromWire(args, DistrCall))
+  if command == 'modifyReferenceCount':
+    ref = fromWire(args['ref'], LiteralRef)
+    delta = args['delta']
+    model.modifyReferenceCount(ref, delta)
+    return None
+  if command in ('JSONToRef', 'readJSON'):
+    return model.JSONToRef(args)
+  if command in ('refToJSON', 'writeJSON'):
+    return model.refToJSON(fromWire(args, LiteralRef))
+  if command == 'isEqual':
+    return model.isEqual(fromWire(args[0], LiteralRef),
+                         fromWire(args[1], LiteralRef))
+  if command == 'expandCall':
+    return expandCall(model, fromWire(args['call'], DistrCall),
+                      args['maxDepth'], args['maxCalls'])
+  raise Exception("unknown command: " + command)
+
+def isExpandable(call):
+  """
+  Whether a call inside a distribution can be expanded ahead of sampling:
+  it isn't primitive, and its parameters don't depend on sampled variables.
+  """
+  return not call.isPrimitive() and \
+    all(isinstance(p, LiteralRef) for p in call.parameters)
+
+def expandCall(model, call, maxDepth, maxCalls):
+  """
+  Gets the distribution of call, and then recursively those of the
+  expandable calls (see isExpandable) inside it, to a depth of maxDepth and
+  at most maxCalls distinct calls.
+
+  Returns {'result': distrResult of call, 'expanded': [[call, distrResult,
+  uses], ...]}, with one entry per distinct sub-call.  uses is the number of
+  times the sub-call is made when sampling call once (counting only the
+  expanded levels).  The model is queried once per distinct sub-call, and the
+  references of its distribution are multiplied by uses, so each use owns a
+  copy.  The caller still owns the sub-calls' parameters.
+  """
+  top = model.getDistribution(call)
+  expanded = {}
+  level = [(top.distribution, 1)]
+  for depth in range(maxDepth):
+    uses = Counter()
+    for distr, distrUses in level:
+      for assn in distr.assignments:
+        if isExpandable(assn.call):
+          uses[assn.call] += distrUses
+    level = []
+    for subcall, subcallUses in uses.items():
+      if subcall not in expanded:
+        if len(expanded) >= maxCalls:
+          continue
+        for p in subcall.parameters:
+          model.modifyReferenceCount(p, 1)
+        expanded[subcall] = [model.getDistribution(subcall), 0]
+      entry = expanded[subcall]
+      entry[1] += subcallUses
+      level.append((entry[0].distribution, subcallUses))
+  for subcall, (distrResult, uses) in expanded.items():
+    refs = algprob.distributionLiteralRefs(distrResult.distribution)
+    for ref, count in Counter(refs).items():
+      model.modifyReferenceCount(ref, (uses - 1) * count)
+  return {'result': top,
+          'expanded': [[subcall, distrResult, uses]
+                       for subcall, (distrResult, uses) in expanded.items()]}
 
 class SocketModelServer:
   """
@@ -20,40 +144,184 @@ class SocketModelServer:
     """
     Runs the server.
     """
-    query = ""
+    query = b''
     while True:
       received = self.socket.recv(SocketModelServer.BUFSIZE)
+      if len(received) == 0:
+        return
       query += received
-      if '\n' in received:
-        self.doQuery(query)
-        query = ""
+      while b'\n' in query:
+        line, _, query = query.partition(b'\n')
+        self.doQuery(line.decode('utf-8'))
       time.sleep(0)
 
-
   def getQueryResult(self, query):
-    split = query.find(' ')
-    assert split != -1
-    command = query[0 : split]
-    jsonObj = json.loads(query[split + 1 :])
-    if command == 'getDistribution':
-      call = DistrCall.fromJSON(jsonObj)
-      return self.model.getDistribution(call).toJSON()
-    if command == 'modifyReferenceCount':
-      ref = jsonObj['ref']
-      delta = jsonObj['delta']
-      self.model.modifyReferenceCount(ref, delta)
-      return None
-    if command == 'readJSON':
-      return self.model.readJSON(jsonObj).toJSON()
-    if command == 'writeJSON':
-      return self.model.writeJSON(LiteralRef.fromJSON(jsonObj))
-    if command == 'isEqual':
-      return self.model.isEqual(jsonObj[0], jsonObj[1])
+    requestId, command, jsonObj = parseQuery(query)
+    return getQueryResult(self.model, command, jsonObj)
 
   def doQuery(self, query):
-    res = self.getQueryResult(query)
-    self.socket.sendAll(json.dumps(res) + '\n')
+    requestId, command, jsonObj = parseQuery(query)
+    if command == 'negotiate':
+      # this server only speaks JSON
+      res = 'json'
+    else:
+      res = getQueryResult(self.model, command, jsonObj)
+    self.socket.sendall(formatReply(requestId, res).encode('utf-8'))
+
+
+class AsyncModelServer:
+  """
+  Serves a model to any number of concurrent SocketModelClients using
+  asyncio.
+
+  Each connection's queries are read by the event loop and answered in
+  order; clients may pipeline queries, sending more before earlier replies
+  arrive.  A client can negotiate the binary format of wireformat, in which
+  queries and replies are length-prefixed frames.
+
+  Model calls run on executor, so a slow getDistribution never blocks the
+  event loop or other connections.  The default executor has maxInFlight
+  threads, so the model must be thread-safe (as PythonFunctionModel is);
+  pass a single-thread executor to serve a model that isn't.
+
+  A query that fails gets an error reply tagged with its request id (see
+  formatErrorReply; in the binary format, a [requestId, None, message]
+  frame), and the connection carries on.  Queries without a request id
+  can't be told apart, so a failure among them closes the connection.
+
+  maxConnections bounds the number of open connections (further connections
+  are closed immediately), maxInFlight the number of queries being run on
+  the executor at once, and maxQueueDepth the number of queries read ahead
+  per connection before the server stops reading from it.
+  """
+
+  # longest query line accepted, in bytes
+  MAX_LINE = 1 << 26
+
+  def __init__(self, model, executor=None, maxConnections=64, maxInFlight=4,
+               maxQueueDepth=16):
+    assert maxConnections > 0 and maxInFlight > 0 and maxQueueDepth > 0
+    self.model = model
+    if executor is None:
+      executor = ThreadPoolExecutor(max_workers=maxInFlight)
+    self.executor = executor
+    self.maxConnections = maxConnections
+    self.maxInFlight = maxInFlight
+    self.maxQueueDepth = maxQueueDepth
+    self.connections = 0
+    self.inFlight = None
+    self.server = None
+
+  async def start(self, host='127.0.0.1', port=0):
+    """
+    Starts listening on (host, port) and returns the asyncio server.
+    """
+    self.inFlight = asyncio.Semaphore(self.maxInFlight)
+    self.server = await asyncio.start_server(
+      self.handleConnection, host, port, limit=AsyncModelServer.MAX_LINE)
+    return self.server
+
+  async def serveForever(self, host='127.0.0.1', port=0):
+    server = await self.start(host, port)
+    async with server:
+      await server.serve_forever()
+
+  def run(self, host='127.0.0.1', port=0):
+    """
+    Runs the server until interrupted.
+    """
+    asyncio.run(self.serveForever(host, port))
+
+  def chooseFormat(self, args):
+    """
+    Answers a negotiate query, picking the wire format for the rest of the
+    connection.
+    """
+    if 'binary' in args.get('formats', []):
+      return 'binary'
+    return 'json'
 
+  async def readQuery(self, reader, binary):
+    """
+    Reads the next query from a connection, returning (requestId, command,
+    args), or None at the end of the connection.
+    """
+    if binary:
+      try:
+        header = await reader.readexactly(4)
+      except asyncio.IncompleteReadError:
+        return None
+      payload = await reader.readexactly(wireformat.UINT32.unpack(header)[0])
+      return tuple(wireformat.decode(payload))
+    line = await reader.readline()
+    if len(line) == 0:
+      return None
+    return parseQuery(line.decode('utf-8'))
 
+  async def runQuery(self, command, args):
+    """
+    Runs a query on the executor, returning its result.
+    """
+    async with self.inFlight:
+      return await asyncio.get_running_loop().run_in_executor(
+        self.executor, getQueryResult, self.model, command, args)
 
+  async def answerQueries(self, queue, writer):
+    failed = False
+    while True:
+      query = await queue.get()
+      if query is None:
+        return
+      if failed:
+        # keep draining the queue so the reader never blocks on it
+        continue
+      binary, requestId, command, args = query
+      try:
+        try:
+          if command == 'negotiate':
+            res = self.chooseFormat(args)
+          else:
+            res = await self.runQuery(command, args)
+          if binary:
+            reply = wireformat.encodeFrame([requestId, res])
+          else:
+            reply = formatReply(requestId, res).encode('utf-8')
+        except Exception as exc:
+          if requestId is None:
+            raise
+          # the client gets the error; it isn't the server's to report
+          if binary:
+            reply = wireformat.encodeFrame([requestId, None, errorMessage(exc)])
+          else:
+            reply = formatErrorReply(requestId, errorMessage(exc)).encode('utf-8')
+        writer.write(reply)
+        await writer.drain()
+      except Exception:
+        traceback.print_exc()
+        failed = True
+        writer.close()
 
+  async def handleConnection(self, reader, writer):
+    if self.connections >= self.maxConnections:
+      writer.close()
+      return
+    self.connections += 1
+    queue = asyncio.Queue(maxsize=self.maxQueueDepth)
+    answering = asyncio.ensure_future(self.answerQueries(queue, writer))
+    binary = False
+    try:
+      while True:
+        query = await self.readQuery(reader, binary)
+        if query is None:
+          break
+        requestId, command, args = query
+        await queue.put((binary, requestId, command, args))
+        if command == 'negotiate':
+          # the client waits for the reply before using the new format
+          binary = self.chooseFormat(args) == 'binary'
+      await queue.put(None)
+      await answering
+    finally:
+      answering.cancel()
+      self.connections -= 1
+      writer.close()
@@ -0,0 +1,69 @@
+# Sampling a PythonDistributionSystem in parallel over a process pool.
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import random
+
+import numpy as np
+
+from distribution import DistrCall
+from model import WrappedModel
+from sample import sample
+
+# The model of the current worker process, set up by initWorker.
+workerModel = None
+
+def initWorker(systemClass):
+  global workerModel
+  workerModel = WrappedModel(systemClass().getModel())
+
+def sampleSeed(seed, index):
+  """
+  The seed for sample number index of a run seeded with seed.  Seeds are
+  spawned from a numpy SeedSequence, so the streams of different samples are
+  independent and do not depend on how samples are split among workers.
+  """
+  sequence = np.random.SeedSequence(seed, spawn_key=(index,))
+  return int(sequence.generate_state(1, np.uint64)[0])
+
+def sampleRange(model, function, args, seed, start, stop):
+  """
+  Draws samples start, ..., stop - 1 of function(*args), returning a list
+  of their results as JSON.  Releases all references it creates.
+  """
+  results = []
+  for index in range(start, stop):
+    rng = random.Random(sampleSeed(seed, index))
+    call = DistrCall(function, [model.JSONToRef(a) for a in args])
+    res = sample(model, call, rng)
+    results.append([model.refToJSON(r) for r in res])
+    for r in res:
+      model.modifyReferenceCount(r, -1)
+  return results
+
+def sampleChunk(function, args, seed, start, stop):
+  # results go back as a single JSON string, which is much cheaper to pickle
+  # than per-sample lists of objects
+  return json.dumps(sampleRange(workerModel, function, args, seed, start, stop))
+
+def parallelSample(systemClass, function, args, n, seed=0, workers=None,
+                   chunkSize=1000):
+  """
+  Draws n samples of the call function(*args) in the model of systemClass (a
+  PythonDistributionSystem subclass, which must be picklable), using a pool
+  of worker processes that each build their own model.  args are JSON values.
+
+  Returns a list of n results, each a list of JSON values.  Sample i only
+  depends on seed and i, so the results are the same for any number of
+  workers or chunk size.
+  """
+  assert chunkSize > 0
+  with ProcessPoolExecutor(max_workers=workers, initializer=initWorker,
+                           initargs=(systemClass,)) as executor:
+    futures = [executor.submit(sampleChunk, function, args, seed,
+                               start, min(start + chunkSize, n))
+               for start in range(0, n, chunkSize)]
+    results = []
+    for future in futures:
+      results.extend(json.loads(future.result()))
+  return results
@@ -0,0 +1,235 @@
+# Primitive distributions, sampled and scored natively rather than through
+# getDistribution.  Parameters and results are JSON values.
+
+import math
+import numbers
+
+import numpy as np
+
+class Primitive(object):
+  """
+  A primitive distribution.  Subclasses define:
+
+    sample(params, rng): one draw, with rng a random.Random (or the random
+      module).
+    sampleBatch(params, n, rng): n draws as a numpy array, with rng a
+      numpy Generator.
+    logProb(params, value): the log-probability (or, for continuous
+      distributions, the log-density) of value.
+    support(params): a list of (value, logProb) pairs covering every
+      possible value, or None if there are infinitely many.
+  """
+
+  name = None
+
+  def support(self, params):
+    return None
+
+class Bernouli(Primitive):
+  """
+  bernouli(p): True with probability p, else False.
+  """
+
+  name = 'bernouli'
+
+  def checkParams(self, params):
+    assert len(params) == 1
+    p, = params
+    assert isinstance(p, numbers.Real)
+    assert 0 <= p <= 1
+    return p
+
+  def sample(self, params, rng):
+    return rng.random() < self.checkParams(params)
+
+  def sampleBatch(self, params, n, rng):
+    return rng.random(n) < self.checkParams(params)
+
+  def logProb(self, params, value):
+    p = self.checkParams(params)
+    q = p if value is True else 1 - p if value is False else 0
+    return math.log(q) if q > 0 else float('-inf')
+
+  def support(self, params):
+    p = self.checkParams(params)
+    res = []
+    if p > 0:
+      res.append((True, math.log(p)))
+    if p < 1:
+      res.append((False, math.log(1 - p)))
+    return res
+
+class Categorical(Primitive):
+  """
+  categorical(probs): index i with probability probs[i].
+  """
+
+  name = 'categorical'
+
+  def checkParams(self, params):
+    assert len(params) == 1
+    probs, = params
+    assert isinstance(probs, list) and len(probs) > 0
+    assert all(p >= 0 for p in probs)
+    assert abs(sum(probs) - 1) < 1e-9
+    return probs
+
+  def sample(self, params, rng):
+    probs = self.checkParams(params)
+    x = rng.random()
+    for i, p in enumerate(probs):
+      x -= p
+      if x < 0:
+        return i
+    # rounding can leave x just above 0; use the last possible outcome
+    return max(i for i, p in enumerate(probs) if p > 0)
+
+  def sampleBatch(self, params, n, rng):
+    probs = np.array(self.checkParams(params), dtype=float)
+    return rng.choice(len(probs), size=n, p=probs / probs.sum())
+
+  def logProb(self, params, value):
+    probs = self.checkParams(params)
+    if isinstance(value, bool) or not isinstance(value, int) or \
+       not 0 <= value < len(probs) or probs[value] == 0:
+      return float('-inf')
+    return math.log(probs[value])
+
+  def support(self, params):
+    probs = self.checkParams(params)
+    return [(i, math.log(p)) for i, p in enumerate(probs) if p > 0]
+
+class UniformInt(Primitive):
+  """
+  uniformInt(lo, hi): an integer in lo, ..., hi - 1, uniformly (like range).
+  """
+
+  name = 'uniformInt'
+
+  def checkParams(self, params):
+    assert len(params) == 2
+    lo, hi = params
+    assert isinstance(lo, int) and isinstance(hi, int) and lo < hi
+    return lo, hi
+
+  def sample(self, params, rng):
+    lo, hi = self.checkParams(params)
+    return lo + min(int(rng.random() * (hi - lo)), hi - lo - 1)
+
+  def sampleBatch(self, params, n, rng):
+    lo, hi = self.checkParams(params)
+    return rng.integers(lo, hi, size=n)
+
+  def logProb(self, params, value):
+    lo, hi = self.checkParams(params)
+    if isinstance(value, bool) or not isinstance(value, int) or \
+       not lo <= value < hi:
+      return float('-inf')
+    return -math.log(hi - lo)
+
+  def support(self, params):
+    lo, hi = self.checkParams(params)
+    return [(i, -math.log(hi - lo)) for i in range(lo, hi)]
+
+class Binomial(Primitive):
+  """
+  binomial(n, p): the number of successes in n trials of probability p.
+  """
+
+  name = 'binomial'
+
+  def checkParams(self, params):
+    assert len(params) == 2
+    n, p = params
+    assert isinstance(n, int) and n >= 0
+    assert 0 <= p <= 1
+    return n, p
+
+  def sample(self, params, rng):
+    n, p = self.checkParams(params)
+    if p == 0 or p == 1:
+      return int(n * p)
+    pmf = (1 - p) ** n
+    if pmf == 0:
+      # too many trials for inversion; count them one by one
+      return sum(1 for i in range(n) if rng.random() < p)
+    # inversion, walking the pmf up from 0; takes about n * p steps
+    x = rng.random()
+    ratio = p / (1 - p)
+    for k in range(n):
+      x -= pmf
+      if x < 0:
+        return k
+      pmf *= (n - k) / (k + 1) * ratio
+    return n
+
+  def sampleBatch(self, params, n, rng):
+    trials, p = self.checkParams(params)
+    return rng.binomial(trials, p, size=n)
+
+  def logProb(self, params, value):
+    n, p = self.checkParams(params)
+    if isinstance(value, bool) or not isinstance(value, int) or \
+       not 0 <= value <= n:
+      return float('-inf')
+    if p == 0 or p == 1:
+      return 0.0 if value == n * p else float('-inf')
+    return (math.lgamma(n + 1) - math.lgamma(value + 1) -
+            math.lgamma(n - value + 1) +
+            value * math.log(p) + (n - value) * math.log(1 - p))
+
+  def support(self, params):
+    n, p = self.checkParams(params)
+    res = []
+    for k in range(n + 1):
+      logProb = self.logProb(params, k)
+      if logProb != float('-inf'):
+        res.append((k, logProb))
+    return res
+
+class Beta(Primitive):
+  """
+  beta(a, b): a float in [0, 1] with the Beta(a, b) density.  Continuous, so
+  it has no support list and can't be enumerated.
+  """
+
+  name = 'beta'
+
+  def checkParams(self, params):
+    assert len(params) == 2
+    a, b = params
+    assert a > 0 and b > 0
+    return a, b
+
+  def sample(self, params, rng):
+    a, b = self.checkParams(params)
+    return rng.betavariate(a, b)
+
+  def sampleBatch(self, params, n, rng):
+    a, b = self.checkParams(params)
+    return rng.beta(a, b, size=n)
+
+  def logProb(self, params, value):
+    a, b = self.checkParams(params)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+       not 0 < value < 1:
+      return float('-inf')
+    return ((a - 1) * math.log(value) + (b - 1) * math.log(1 - value) +
+            math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b))
+
+PRIMITIVES = dict((p.name, p) for p in
+                  [Bernouli(), Categorical(), UniformInt(), Binomial(), Beta()])
+
+def isPrimitive(function):
+  return function in PRIMITIVES
+
+def getPrimitive(function):
+  return PRIMITIVES.get(function)
+
+def toJSONValue(x):
+  """
+  Converts a numpy scalar drawn by sampleBatch to a JSON value.
+  """
+  if isinstance(x, np.generic):
+    return x.item()
+  return x
@@ -2,6 +2,7 @@
 
 import algprob
 from distribution import DistrCall, DistrValue, Distribution, LiteralRef
+import primitives
 from util import makeDataClass
 
 class ProofVar(DistrValue):
@@ -9,9 +10,12 @@ class ProofVar(DistrValue):
   A placeholder for use in a DistrCall or Distribution.  Multiple uses of the
   same variable should be equal.
   """
+
+  __slots__ = ('varid', '_hash')
+
   def __init__(self, varid):
     assert isinstance(varid, int)
-    self.varid = varid
+    self.initFields(varid)
 
   def getData(self):
     return (self.varid,)
@@ -19,7 +23,7 @@ class ProofVar(DistrValue):
   def toJSON(self):
     return {'type': 'proofvar', 'varid': self.varid}
 
-makeDataClass(ProofVar)
+makeDataClass(ProofVar, frozen=True)
 
 def isProofValue(value):
   return isinstance(value, LiteralRef) or isinstance(value, ProofVar)
@@ -31,13 +35,14 @@ class ProbLabel:
   equal to the results.
   """
 
+  __slots__ = ('call', 'result', '_hash')
+
   def __init__(self, call, result):
     assert isinstance(call, DistrCall)
     assert all(map(isProofValue, call.parameters))
     result = tuple(result)
     assert all(isinstance(x, LiteralRef) for x in result)
-    self.call = call
-    self.result = result
+    self.initFields(call, result)
 
   def getData(self):
     return (self.call, self.result)
@@ -45,11 +50,24 @@ class ProbLabel:
   def prettyString(self):
     return str(self.call) + " -> " + ' '.join(map(str, self.result))
 
+  def primitiveLogProb(self, model):
+    """
+    For a label of a primitive call (see primitives.py) without ProofVars,
+    the log-probability of its result (a log-density, for continuous
+    primitives).  Does not modify any reference counts.
+    """
+    primitive = primitives.getPrimitive(self.call.function)
+    assert primitive is not None
+    assert all(isinstance(p, LiteralRef) for p in self.call.parameters)
+    assert len(self.result) == 1
+    return primitive.logProb([model.refToJSON(p) for p in self.call.parameters],
+                             model.refToJSON(self.result[0]))
+
   def toJSON(self):
     return {'call': self.call.toJSON(),
             'result': [r.toJSON() for r in self.result]}
 
-makeDataClass(ProbLabel)
+makeDataClass(ProbLabel, frozen=True)
 
 class VariableMapping:
   """
@@ -70,12 +88,13 @@ class VariableMapping:
 
   def getCallLabels(self, distr):
     assert isinstance(distr, Distribution)
-    values = {}
+    plan = algprob.compileDistribution(distr)
+    slots = plan.newSlots()
     labels = []
-    for assn in distr.assignments:
-      call = algprob.resolveCall(values, assn.call)
-      result = [self.values[v] for v in assn.variables]
-      algprob.addValues(values, assn.variables, result)
+    for step in plan.steps:
+      call = plan.resolveCall(slots, step)
+      result = [self.values[v] for v in step.variables]
+      plan.setOutputs(slots, step, result)
       labels.append(ProbLabel(call, result))
     return labels
 
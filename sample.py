@@ -3,34 +3,380 @@ from collections import defaultdict
 import math
 import numbers
 import random
+import time
 
-from distribution import CallRef, DistrCall, Distribution, LiteralRef
+import numpy as np
+
+from distribution import CallRef, DistrCall, Distribution, LiteralRef, LocalVariable
 from model import DistrResult, Model
+from primitives import PRIMITIVES, toJSONValue
+from util import agrestiCoullLower, agrestiCoullUpper
 
 import algprob
 
-def sampleDistr(model, distribution):
+def samplePrimitive(model, primitive, call, rng):
+  """
+  Samples a call of a primitive (see primitives.py), consuming its
+  parameters.
+  """
+  params = [model.refToJSON(p) for p in call.parameters]
+  for p in call.parameters:
+    model.modifyReferenceCount(p, -1)
+  return [model.JSONToRef(primitive.sample(params, rng))]
+
+
+class SampleFrame(object):
+  """
+  A Distribution being sampled by a SampleMachine: its plan, the values of
+  its slots so far, and the index of the next step to run.
+  """
+
+  __slots__ = ('plan', 'slots', 'steps', 'slotUses', 'index')
+
+  def __init__(self, plan, steps, slotUses):
+    self.plan = plan
+    self.slots = plan.newSlots()
+    self.steps = steps
+    self.slotUses = slotUses
+    self.index = 0
+
+class SampleMachine(object):
+  """
+  Samples a call (or a Distribution, see pushDistribution) with an explicit
+  stack of SampleFrames instead of recursion, so the depth of the model is
+  unbounded.
+
+  Normally run() asks the model for distributions itself.  With
+  pauseOnCalls set, it instead returns None whenever it needs the
+  distribution of a call, leaving the call in pendingCall; the caller gets the
+  DistrResult however it likes (say, asynchronously), passes it to provide()
+  and calls run() again.  The reference counting is the same as for
+  model.getDistribution.  See sampleDistr for lazy.
+  """
+
+  def __init__(self, model, call=None, rng=random, lazy=False,
+               pauseOnCalls=False):
+    assert isinstance(model, Model)
+    assert call is None or isinstance(call, DistrCall)
+    self.model = model
+    self.rng = rng
+    self.lazy = lazy
+    self.pauseOnCalls = pauseOnCalls
+    self.frames = []
+    self.pendingCall = call
+    self.result = None
+
+  def pushDistribution(self, distribution):
+    assert isinstance(distribution, Distribution)
+    plan = algprob.compileDistribution(distribution)
+    if self.lazy:
+      plan.computeLiveness()
+      for ref in plan.deadConstants:
+        self.model.modifyReferenceCount(ref, -1)
+      self.frames.append(SampleFrame(plan, plan.liveSteps, plan.liveSlotUses))
+    else:
+      self.frames.append(SampleFrame(plan, plan.steps, plan.slotUses))
+
+  def provide(self, distrResult):
+    """
+    Supplies the distribution of pendingCall, after run() paused on it.
+    """
+    assert self.pendingCall is not None
+    self.pendingCall = None
+    self.pushDistribution(distrResult.distribution)
+
+  def run(self):
+    """
+    Runs until the sample is complete and returns its result (also kept in
+    result), or returns None if paused on pendingCall.
+    """
+    model = self.model
+    rng = self.rng
+    frames = self.frames
+    call = self.pendingCall
+    self.pendingCall = None
+    while True:
+      returned = None
+      if call is not None:
+        primitive = PRIMITIVES.get(call.function)
+        if primitive is not None:
+          returned = samplePrimitive(model, primitive, call, rng)
+        elif self.pauseOnCalls:
+          self.pendingCall = call
+          return None
+        else:
+          self.pushDistribution(model.getDistribution(call).distribution)
+      # pass results up the stack until some frame has a step left to run
+      while True:
+        if returned is not None:
+          if not frames:
+            self.result = returned
+            return returned
+          frame = frames[-1]
+          step = frame.steps[frame.index - 1]
+          slots = frame.slots
+          outputs = step.outputs
+          assert len(returned) == len(outputs)
+          # each value comes with one reference, and each use consumes one
+          slotUses = frame.slotUses
+          for i in range(len(outputs)):
+            o = outputs[i]
+            slots[o] = returned[i]
+            if slotUses[o] != 1:
+              model.modifyReferenceCount(returned[i], slotUses[o] - 1)
+        else:
+          frame = frames[-1]
+        index = frame.index
+        if index < len(frame.steps):
+          frame.index = index + 1
+          call = frame.plan.resolveCall(frame.slots, frame.steps[index])
+          break
+        frames.pop()
+        returned = frame.plan.resolveResult(frame.slots)
+
+
+def sampleDistr(model, distribution, rng=random, lazy=False):
+  """
+  Samples distribution once.  If lazy is set, assignments the result doesn't
+  depend on are skipped rather than sampled (see
+  DistributionPlan.computeLiveness), here and in nested calls.
+  """
+  machine = SampleMachine(model, None, rng, lazy)
+  machine.pushDistribution(distribution)
+  return machine.run()
+
+
+def sample(model, call, rng=random, lazy=False):
+  """
+  Samples call once.  rng is the source of randomness (anything with a
+  random() method, such as a random.Random); by default the global random
+  module is used.  See sampleDistr for lazy.
+  """
   assert isinstance(model, Model)
+  assert isinstance(call, DistrCall)
+  primitive = PRIMITIVES.get(call.function)
+  if primitive is not None:
+    return samplePrimitive(model, primitive, call, rng)
+  return SampleMachine(model, call, rng, lazy).run()
+
+
+class EventEstimate(object):
+  """
+  Running count of how often an event held among the samples drawn so far,
+  with its Agresti-Coull confidence interval.
+  """
+
+  def __init__(self, z=1.96):
+    self.z = z
+    self.successes = 0
+    self.trials = 0
+
+  def add(self, success):
+    self.trials += 1
+    if success:
+      self.successes += 1
+
+  def estimate(self):
+    return self.successes / self.trials if self.trials else 0.5
+
+  def lower(self):
+    return max(0.0, agrestiCoullLower(self.z, self.successes, self.trials))
+
+  def upper(self):
+    return min(1.0, agrestiCoullUpper(self.z, self.successes, self.trials))
+
+  def width(self):
+    return self.upper() - self.lower()
+
+def streamSamples(model, call, event, width=0.02, z=1.96, maxSamples=None,
+                  maxTime=None, rng=random):
+  """
+  Samples call repeatedly, yielding (values, estimate) after each sample:
+  values is the list of JSON result values, and estimate the EventEstimate of
+  how often event(values) has held.  Stops once the confidence interval is
+  narrower than width, maxSamples samples have been drawn or maxTime seconds
+  have passed.
+
+  The parameters of call are consumed right away, before the generator is
+  returned, so it holds no references even if it is never run.
+  """
+  assert isinstance(call, DistrCall)
+  params = [model.refToJSON(p) for p in call.parameters]
+  for p in call.parameters:
+    model.modifyReferenceCount(p, -1)
+  return generateSamples(model, call.function, params, event, width, z,
+                         maxSamples, maxTime, rng)
+
+def generateSamples(model, function, params, event, width, z, maxSamples,
+                    maxTime, rng):
+  """
+  The generator behind streamSamples, sampling function on params (JSON
+  values) with fresh references each time.
+  """
+  estimate = EventEstimate(z)
+  start = time.time()
+  while True:
+    res = sample(model, DistrCall(function, [model.JSONToRef(p) for p in params]), rng)
+    values = list(map(model.refToJSON, res))
+    for r in res:
+      model.modifyReferenceCount(r, -1)
+    estimate.add(event(values))
+    yield values, estimate
+    if estimate.width() < width:
+      return
+    if maxSamples is not None and estimate.trials >= maxSamples:
+      return
+    if maxTime is not None and time.time() - start >= maxTime:
+      return
+
+def estimateProbability(model, call, event, width=0.02, z=1.96,
+                        maxSamples=None, maxTime=None, rng=random):
+  """
+  Runs streamSamples to the end and returns the final EventEstimate.
+  """
+  estimate = EventEstimate(z)
+  for values, estimate in streamSamples(model, call, event, width, z,
+                                        maxSamples, maxTime, rng):
+    pass
+  return estimate
+
+
+class ValueTable(object):
+  """
+  The distinct LiteralRefs seen while sampling a batch.  Each entry holds one
+  reference; columns of a batch are integer arrays indexing into the table.
+  """
+
+  def __init__(self, model):
+    self.model = model
+    self.refs = []
+    self.indices = {}
+
+  def add(self, ref):
+    """
+    Takes over one reference to ref and returns its index in the table.
+    """
+    index = self.indices.get(ref)
+    if index is None:
+      index = len(self.refs)
+      self.indices[ref] = index
+      self.refs.append(ref)
+    else:
+      self.model.modifyReferenceCount(ref, -1)
+    return index
+
+  def compact(self, columns):
+    """
+    Releases every entry not used by columns.  Returns the used refs and
+    columns re-indexed into them.
+    """
+    if len(columns) > 0:
+      used = np.unique(np.concatenate(columns))
+    else:
+      used = np.zeros(0, dtype=np.intp)
+    remap = np.full(len(self.refs), -1, dtype=np.intp)
+    remap[used] = np.arange(len(used))
+    for index, ref in enumerate(self.refs):
+      if remap[index] == -1:
+        self.model.modifyReferenceCount(ref, -1)
+    return [self.refs[i] for i in used], [remap[c] for c in columns]
+
+
+def groupRows(columns, n):
+  """
+  Groups the n rows of the given parameter columns by their values.  Yields
+  (rowIndices, values) for each distinct row.
+  """
+  if n == 0:
+    return
+  if len(columns) == 0:
+    yield np.arange(n), ()
+    return
+  stacked = np.stack(columns)
+  distinct, inverse = np.unique(stacked, axis=1, return_inverse=True)
+  inverse = inverse.reshape(-1)
+  order = np.argsort(inverse, kind='stable')
+  bounds = np.cumsum(np.bincount(inverse, minlength=distinct.shape[1]))
+  start = 0
+  for group, end in enumerate(bounds):
+    yield order[start:end], tuple(distinct[:, group])
+    start = end
+
+def sampleDistrBatch(model, distribution, n, rng, lazy=False):
+  """
+  Samples distribution n times.  Returns (refs, columns) where refs is a list
+  of distinct LiteralRefs each holding one reference, and columns contains an
+  integer array (of length n, indexing into refs) per result value.  See
+  sampleDistr for lazy.
+  """
   assert isinstance(distribution, Distribution)
-  values = {}
-  for assn in distribution.assignments:
-    resolvedCall = algprob.resolveCall(values, assn.call)
-    res = sample(model, resolvedCall)
-    algprob.addValues(values, assn.variables, res)
-  return tuple(algprob.resolveValue(values, r) for r in distribution.result)
+  plan = algprob.compileDistribution(distribution)
+  table = ValueTable(model)
+  slots = plan.newSlots()
+  steps = plan.steps
+  if lazy:
+    plan.computeLiveness()
+    for ref in plan.deadConstants:
+      model.modifyReferenceCount(ref, -1)
+    steps = plan.liveSteps
 
+  def resolveColumn(param):
+    if param.__class__ is int:
+      return slots[param]
+    return np.full(n, table.add(param), dtype=np.intp)
 
-def sample(model, call):
+  for step in steps:
+    paramColumns = [resolveColumn(p) for p in step.params]
+    outColumns = [np.empty(n, dtype=np.intp) for o in step.outputs]
+    for rows, paramIndices in groupRows(paramColumns, n):
+      params = [table.refs[i] for i in paramIndices]
+      for p in params:
+        model.modifyReferenceCount(p, 1)
+      subRefs, subColumns = sampleCallBatch(
+        model, DistrCall(step.function, params), len(rows), rng, lazy)
+      remap = np.array([table.add(r) for r in subRefs], dtype=np.intp)
+      assert len(subColumns) == len(outColumns)
+      for out, sub in zip(outColumns, subColumns):
+        out[rows] = remap[sub]
+    plan.setOutputs(slots, step, outColumns)
+  return table.compact([resolveColumn(r) for r in plan.result])
+
+def sampleCallBatch(model, call, n, rng, lazy=False):
+  """
+  Samples call n times, consuming one reference to each of its parameters.
+  Returns (refs, columns) like sampleDistrBatch.
+  """
+  primitive = PRIMITIVES.get(call.function)
+  if primitive is not None:
+    params = [model.refToJSON(p) for p in call.parameters]
+    for p in call.parameters:
+      model.modifyReferenceCount(p, -1)
+    draws = primitive.sampleBatch(params, n, rng)
+    distinct, inverse = np.unique(draws, return_inverse=True)
+    refs = [model.JSONToRef(toJSONValue(v)) for v in distinct]
+    return refs, [inverse.reshape(-1).astype(np.intp)]
+  distrResult = model.getDistribution(call)
+  return sampleDistrBatch(model, distrResult.distribution, n, rng, lazy)
+
+def sampleMany(model, call, n, rng=None, lazy=False):
+  """
+  Draws n independent samples of call at once.  Returns a tuple with one
+  column per result value, each a numpy object array of n LiteralRefs.
+
+  Each distinct DistrCall reached is expanded once per batch rather than once
+  per sample, and the outcomes of primitives are drawn as numpy arrays.  The parameters
+  of call are consumed once, as in sample; every occurrence of a LiteralRef in
+  the returned columns holds one reference.
+  """
   assert isinstance(model, Model)
   assert isinstance(call, DistrCall)
-  if call.function == 'bernouli':
-    assert len(call.parameters) == 1
-    p = model.refToJSON(call.parameters[0])
-    assert isinstance(p, numbers.Real)
-    assert 0 <= p <= 1
-    model.modifyReferenceCount(call.parameters[0], -1)
-    res = random.random() < p
-    return [model.JSONToRef(res)]
-  distrResult = model.getDistribution(call)
-  res = sampleDistr(model, distrResult.distribution)
-  return res
+  if rng is None:
+    rng = np.random.default_rng()
+  refs, columns = sampleCallBatch(model, call, n, rng, lazy)
+  if len(columns) > 0:
+    counts = np.bincount(np.concatenate(columns), minlength=len(refs))
+    for ref, count in zip(refs, counts):
+      model.modifyReferenceCount(ref, int(count) - 1)
+  table = np.empty(len(refs), dtype=object)
+  table[:] = refs
+  return tuple(table[c] for c in columns)
@@ -0,0 +1,361 @@
+# A columnar on-disk store for sample results, backed by numpy memmaps.
+
+import json
+import os
+
+import numpy as np
+
+from distribution import DistrCall
+from model import Model
+from sample import sampleMany
+
+# column kinds, with the dtype of their data file; 'dict' columns hold
+# indices into a dictionary of distinct values
+DTYPES = {'bool': np.bool_, 'int': np.int64, 'float': np.float64, 'dict': np.int64}
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+def canonicalJSON(value):
+  return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+def kindOf(value):
+  if isinstance(value, bool):
+    return 'bool'
+  if isinstance(value, int) and INT64_MIN <= value <= INT64_MAX:
+    return 'int'
+  if isinstance(value, float):
+    return 'float'
+  return 'dict'
+
+def joinKinds(a, b):
+  """
+  The kind of a column holding values of kinds a and b: ints and floats go
+  in a float column, and any other mixture in a dict column.
+  """
+  if a is None or a == b:
+    return b
+  if set([a, b]) == set(['int', 'float']):
+    return 'float'
+  return 'dict'
+
+
+class StoreColumn(object):
+  """
+  One column of a SampleStoreWriter: a data file mapped as a numpy memmap,
+  grown by doubling, plus for dict columns a file of the dictionary's values
+  (canonical JSON, one per line) that is only ever appended to.
+  """
+
+  def __init__(self, directory, index):
+    self.directory = directory
+    self.index = index
+    self.kind = None
+    self.data = None
+    self.capacity = 0
+    self.dictionary = []
+    self.codes = {}
+    self.dictionaryFile = None
+    # data files replaced by promotion, to delete once metadata.json no
+    # longer names them
+    self.staleFiles = []
+
+  def fileName(self, kind):
+    return 'col%d.%s' % (self.index, kind)
+
+  def path(self, name):
+    return os.path.join(self.directory, name)
+
+  def open(self, kind, capacity):
+    self.kind = kind
+    self.capacity = capacity
+    self.data = np.memmap(self.path(self.fileName(kind)), dtype=DTYPES[kind],
+                          mode='w+', shape=(capacity,))
+
+  def reserve(self, length, needed):
+    if needed <= self.capacity:
+      return
+    capacity = max(self.capacity, 1024)
+    while capacity < needed:
+      capacity *= 2
+    self.data.flush()
+    del self.data
+    with open(self.path(self.fileName(self.kind)), 'r+b') as f:
+      f.truncate(capacity * np.dtype(DTYPES[self.kind]).itemsize)
+    self.capacity = capacity
+    self.data = np.memmap(self.path(self.fileName(self.kind)),
+                          dtype=DTYPES[self.kind], mode='r+', shape=(capacity,))
+
+  def encode(self, values):
+    """
+    The dictionary codes of values, adding new values to the dictionary.
+    """
+    if self.dictionaryFile is None:
+      # codes start at 0 for each writer, so drop any values left by an
+      # earlier one
+      self.dictionaryFile = open(self.path(self.fileName('values')), 'w')
+    res = np.empty(len(values), dtype=np.int64)
+    for i, value in enumerate(values):
+      key = canonicalJSON(value)
+      code = self.codes.get(key)
+      if code is None:
+        code = self.codes[key] = len(self.dictionary)
+        self.dictionary.append(key)
+        self.dictionaryFile.write(key + '\n')
+      res[i] = code
+    return res
+
+  def promote(self, kind, length):
+    """
+    Converts the first length entries to a column of the given kind.
+    """
+    old = self.data[:length]
+    if kind == 'dict':
+      converted = self.encode(old.tolist())
+    else:
+      converted = np.array(old, dtype=DTYPES[kind])
+    oldName = self.fileName(self.kind)
+    del old
+    self.data.flush()
+    del self.data
+    self.open(kind, max(self.capacity, 1024))
+    self.data[:length] = converted
+    self.staleFiles.append(oldName)
+
+  def append(self, length, values):
+    """
+    Writes values (a list of JSON values) at entries length, ... and returns
+    the new length.
+    """
+    kind = self.kind
+    for value in values:
+      kind = joinKinds(kind, kindOf(value))
+    if self.kind is None:
+      self.open(kind, 1024)
+    elif kind != self.kind:
+      self.promote(kind, length)
+    self.reserve(length, length + len(values))
+    if kind == 'dict':
+      self.data[length:length + len(values)] = self.encode(values)
+    else:
+      self.data[length:length + len(values)] = np.array(values, dtype=DTYPES[kind])
+    return length + len(values)
+
+  def flush(self):
+    if self.data is not None:
+      self.data.flush()
+    if self.dictionaryFile is not None:
+      self.dictionaryFile.flush()
+
+  def removeStaleFiles(self):
+    for name in self.staleFiles:
+      os.remove(self.path(name))
+    self.staleFiles = []
+
+  def close(self):
+    self.flush()
+    if self.dictionaryFile is not None:
+      self.dictionaryFile.close()
+      self.dictionaryFile = None
+    self.data = None
+
+  def getMetadata(self):
+    return {'kind': self.kind, 'file': self.fileName(self.kind),
+            'dictionary': self.fileName('values') if self.kind == 'dict' else None,
+            'dictionarySize': len(self.dictionary)}
+
+
+class SampleStoreWriter(object):
+  """
+  Appends sample results (lists of JSON values, one per result value) to a
+  store in directory, one column per result value.  Bool, int and float
+  columns are memmaps of those types; a column gets promoted (ints to floats,
+  anything else to a dictionary-encoded column) when a value doesn't fit.
+
+  Only the current batch of values is held in memory (plus the dictionaries).
+  The store's metadata.json, which readers go by, is rewritten on flush, so
+  what has been flushed can be read while writing continues.
+  """
+
+  def __init__(self, directory, flushEvery=1 << 16):
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.directory = directory
+    self.flushEvery = flushEvery
+    self.columns = None
+    self.length = 0
+    self.unflushed = 0
+
+  def appendRows(self, rows):
+    """
+    Appends results, each a list of JSON values.
+    """
+    rows = list(rows)
+    if len(rows) == 0:
+      return
+    if self.columns is None:
+      self.columns = [StoreColumn(self.directory, i) for i in range(len(rows[0]))]
+    assert all(len(row) == len(self.columns) for row in rows)
+    self.appendColumns([[row[i] for row in rows] for i in range(len(self.columns))])
+
+  def appendColumns(self, columns):
+    """
+    Appends results given column by column: a list of equally long lists of
+    JSON values, one per result value.
+    """
+    if self.columns is None:
+      self.columns = [StoreColumn(self.directory, i) for i in range(len(columns))]
+    assert len(columns) == len(self.columns)
+    n = len(columns[0]) if columns else 0
+    for column, values in zip(self.columns, columns):
+      assert len(values) == n
+      column.append(self.length, values)
+    self.length += n
+    self.unflushed += n
+    if self.unflushed >= self.flushEvery:
+      self.flush()
+
+  def appendRefColumns(self, model, columns, release=True):
+    """
+    Appends results given as columns of LiteralRefs (as returned by
+    sample.sampleMany).  Each distinct ref is resolved once; unless release
+    is False, one reference is released per occurrence.
+    """
+    assert isinstance(model, Model)
+    valueColumns = []
+    for refs in columns:
+      resolved = {}
+      occurrences = {}
+      values = []
+      for ref in refs:
+        if ref not in resolved:
+          resolved[ref] = model.refToJSON(ref)
+          occurrences[ref] = 0
+        occurrences[ref] += 1
+        values.append(resolved[ref])
+      if release:
+        for ref, count in occurrences.items():
+          model.modifyReferenceCount(ref, -count)
+      valueColumns.append(values)
+    self.appendColumns(valueColumns)
+
+  def flush(self):
+    if self.columns is None:
+      return
+    for column in self.columns:
+      column.flush()
+    metadata = {'length': self.length,
+                'columns': [column.getMetadata() for column in self.columns]}
+    path = os.path.join(self.directory, 'metadata.json')
+    with open(path + '.tmp', 'w') as f:
+      json.dump(metadata, f)
+    os.replace(path + '.tmp', path)
+    # readers now go by the new metadata, so replaced files can go
+    for column in self.columns:
+      column.removeStaleFiles()
+    self.unflushed = 0
+
+  def close(self):
+    self.flush()
+    if self.columns is not None:
+      for column in self.columns:
+        column.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.close()
+
+
+class SampleStore(object):
+  """
+  Reads a store written by SampleStoreWriter.  Columns are memmaps of the
+  data files, so nothing is copied until used.  refresh() picks up what the
+  writer has flushed since.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.refresh()
+
+  def refresh(self):
+    with open(os.path.join(self.directory, 'metadata.json')) as f:
+      self.metadata = json.load(f)
+    self.length = self.metadata['length']
+    self.dictionaries = {}
+
+  def __len__(self):
+    return self.length
+
+  def columnCount(self):
+    return len(self.metadata['columns'])
+
+  def kind(self, index):
+    return self.metadata['columns'][index]['kind']
+
+  def column(self, index):
+    """
+    The data of a column as a read-only memmap: the values themselves for
+    bool, int and float columns, and dictionary codes for dict columns.
+    """
+    info = self.metadata['columns'][index]
+    if self.length == 0:
+      return np.zeros(0, dtype=DTYPES[info['kind']])
+    return np.memmap(os.path.join(self.directory, info['file']),
+                     dtype=DTYPES[info['kind']], mode='r', shape=(self.length,))
+
+  def dictionary(self, index):
+    """
+    The distinct values of a dict column, indexed by code.
+    """
+    if index not in self.dictionaries:
+      info = self.metadata['columns'][index]
+      values = []
+      with open(os.path.join(self.directory, info['dictionary'])) as f:
+        for i in range(info['dictionarySize']):
+          values.append(json.loads(f.readline()))
+      self.dictionaries[index] = values
+    return self.dictionaries[index]
+
+  def values(self, index):
+    """
+    The values of a column as a numpy array (of objects, for dict columns).
+    """
+    data = self.column(index)
+    if self.kind(index) != 'dict':
+      return data
+    table = np.empty(len(self.dictionary(index)), dtype=object)
+    table[:] = self.dictionary(index)
+    return table[data]
+
+  def counts(self, index):
+    """
+    Maps each distinct value of a column (as canonical JSON) to its count.
+    """
+    data = self.column(index)
+    if self.kind(index) == 'dict':
+      counts = np.bincount(data, minlength=len(self.dictionary(index)))
+      return dict((canonicalJSON(v), int(c))
+                  for v, c in zip(self.dictionary(index), counts) if c)
+    distinct, counts = np.unique(data, return_counts=True)
+    return dict((canonicalJSON(v), int(c))
+                for v, c in zip(distinct.tolist(), counts))
+
+
+def storeSamples(model, call, n, writer, rng=None, batchSize=1 << 14, lazy=False):
+  """
+  Draws n samples of call with sample.sampleMany, batchSize at a time, and
+  appends them to writer, so memory use doesn't grow with n.  The call's
+  references are consumed once.
+  """
+  assert isinstance(call, DistrCall)
+  if rng is None:
+    rng = np.random.default_rng()
+  batches = (n + batchSize - 1) // batchSize
+  for p in call.parameters:
+    model.modifyReferenceCount(p, batches - 1)
+  for start in range(0, n, batchSize):
+    columns = sampleMany(model, call, min(batchSize, n - start), rng, lazy)
+    writer.appendRefColumns(model, columns)
+  writer.flush()
@@ -1,10 +1,28 @@
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import tempfile
+import threading
+
 import algprob
+import graphsort
+import wireformat
 from defmodel import export, PythonDistributionSystem
 from distribution import CallRef, DistrCall, Distribution, LiteralRef
-from model import DistrResult, Model, WrappedModel
+from model import DistrResult, DistributionCache, Model, ThreadPoolModel, WrappedModel
 from proof import ProbLabel, Proof, ProofVar, VariableMapping
-from sample import sample
-from proofenv import evaluateProof
+from sample import estimateProbability, sample, streamSamples
+from samplestore import SampleStore, SampleStoreWriter, storeSamples
+from diskcache import PersistentCacheModel
+from elimination import EliminationEngine
+from exact import ExactEngine, SupportBudgetExceeded
+from mcmc import MHSampler
+from weighted import WeightedSampler, likelihoodWeighting
+from modelclient import RemoteModelError, SocketModelClient
+from modelserver import AsyncModelServer
 
 class TestDistributionSystem(PythonDistributionSystem):
 
@@ -29,9 +47,27 @@ class TestDistributionSystem(PythonDistributionSystem):
     v.result = self.makeList(*[v['flip' + str(i)] for i in range(nflips)])
     return v.result
 
+  @export
+  def posteriorBias(self, v):
+    v.bias = self.decideBias()
+    v.flips = self.flipWithBias(3, v.bias)
+    return v.bias
 
   @export
-  def main(self):
+  def biasAndFlips(self, v):
+    v.bias = self.decideBias()
+    v.flips = self.flipWithBias(3, v.bias)
+    v.result = self.makeList(v.bias, v.flips)
+    return v.result
+
+  @export
+  def countFlips(self, v, nflips, bias):
+    v.result = self.binomial(nflips, bias)
+    return v.result
+
+
+  @export
+  def main(self, v):
     v.bias = self.decideBias()
     v.result = self.flipWithBias(20, v.bias)
     return v.result
@@ -44,7 +80,355 @@ def testSample():
     print(res)
     print(list(map(model.refToJSON, res)))
 
+def isClose(a, b):
+  return abs(a - b) < 1e-9
+
+def testExact():
+  model = TestDistributionSystem().getModel()
+  engine = ExactEngine(model)
+  bias = engine.enumerateCall(DistrCall('decideBias', []))
+  assert isClose(bias.probability(0.85), 0.5)
+  assert isClose(bias.probability(0.15), 0.5)
+  assert isClose(bias.totalLogProbability(), 0.0)
+  flips = engine.enumerateCall(
+    DistrCall('flipWithBias', [model.JSONToRef(5), model.JSONToRef(0.85)]))
+  assert isClose(flips.probability([True] * 5), 0.85 ** 5)
+  assert isClose(flips.probability([True, False, True, True, False]),
+                 0.85 ** 3 * 0.15 ** 2)
+  counts = engine.enumerateCall(
+    DistrCall('countFlips', [model.JSONToRef(5), model.JSONToRef(0.85)]))
+  assert isClose(counts.probability(5), 0.85 ** 5)
+  assert isClose(counts.probability(3), 10 * 0.85 ** 3 * 0.15 ** 2)
+  # the engine holds no references, so every ref has been released
+  assert model.getStats()['liveRefs'] == 0
+
+def testElimination():
+  model = TestDistributionSystem().getModel()
+  exact = ExactEngine(model)
+  elimination = EliminationEngine(model, engine=exact)
+  for function in ('decideBias', 'biasAndFlips'):
+    expected = exact.enumerateCall(DistrCall(function, []))
+    table = elimination.eliminateCall(DistrCall(function, []))
+    assert set(table.logProbs) == set(expected.logProbs)
+    for outcome, logProb in expected.logProbs.items():
+      assert isClose(table.logProbs[outcome], logProb)
+  # a single flip, against the exact marginal of the list of flips
+  flips = exact.enumerateCall(
+    DistrCall('flipWithBias', [model.JSONToRef(5), model.JSONToRef(0.85)]))
+  flip3 = sum(math.exp(logProb) for (outcome,), logProb in flips.logProbs.items()
+              if json.loads(outcome)[3])
+  table = elimination.query(
+    DistrCall('flipWithBias', [model.JSONToRef(5), model.JSONToRef(0.85)]), ['flip3'])
+  assert isClose(table.probability(True), flip3)
+  assert isClose(flip3, 0.85)
+  # makeList of 3 flips needs a table of 8 cells
+  try:
+    EliminationEngine(model, maxSupport=4).eliminateCall(
+      DistrCall('flipWithBias', [model.JSONToRef(3), model.JSONToRef(0.5)]))
+    assert False
+  except SupportBudgetExceeded:
+    pass
+  assert model.getStats()['liveRefs'] == 0
+
+def testInterning():
+  model = TestDistributionSystem().getModel()
+  pair = model.JSONToRef((0.2, 0.8))
+  probs = model.JSONToRef([0.2, 0.8])
+  assert probs == pair
+  assert model.refToJSON(probs) == [0.2, 0.8]
+  assert model.JSONToRef(0.0) != model.JSONToRef(-0.0)
+  assert model.JSONToRef(1) != model.JSONToRef(1.0)
+  res = sample(model, DistrCall('categorical', [probs]))
+  assert model.refToJSON(res[0]) in (0, 1)
+
+def testRefCounts():
+  model = TestDistributionSystem().getModel()
+  for i in range(20):
+    res = sample(model, DistrCall('main', []))
+    assert len(model.refToJSON(res[0])) == 20
+    model.modifyReferenceCount(res[0], -1)
+  assert model.getStats()['liveRefs'] == 0
+
+def testStreamSamples():
+  model = TestDistributionSystem().getModel()
+  call = DistrCall('flipWithBias', [model.JSONToRef(2), model.JSONToRef(0.5)])
+  # a stream that is never run holds no references
+  streamSamples(model, call, lambda values: values[0][0])
+  assert model.getStats()['liveRefs'] == 0
+  estimate = estimateProbability(model, DistrCall('decideBias', []),
+                                 lambda values: values[0] == 0.85, width=0.05,
+                                 rng=random.Random(0))
+  assert estimate.width() < 0.05
+  assert estimate.lower() < 0.5 < estimate.upper()
+  assert model.getStats()['liveRefs'] == 0
+
+def testArena():
+  model = TestDistributionSystem().getModel()
+  cache = DistributionCache()
+  wrapped = WrappedModel(model, cache)
+  half = model.JSONToRef(0.5)
+  for i in range(3):
+    with model.arena():
+      res = sample(wrapped, DistrCall('decideBias', []))
+      model.modifyReferenceCount(res[0], -1)
+  # the arenas released neither the cache's references nor the older one to 0.5
+  res = sample(wrapped, DistrCall('decideBias', []))
+  assert model.refToJSON(res[0]) in (0.15, 0.85)
+  model.modifyReferenceCount(res[0], -1)
+  cache.clear(model)
+  assert model.getStats()['liveRefs'] == 1
+  model.modifyReferenceCount(half, -1)
+  assert model.getStats()['liveRefs'] == 0
+  with model.arena():
+    # the result is never released; the arena does it
+    sample(model, DistrCall('flipWithBias', [model.JSONToRef(3), model.JSONToRef(0.3)]))
+  assert model.getStats()['liveRefs'] == 0
+  with model.arena() as outer:
+    with model.arena() as inner:
+      res = sample(model, DistrCall('decideBias', []))
+      inner.close(keep=res)
+    assert model.refToJSON(res[0]) in (0.15, 0.85)
+  assert model.getStats()['liveRefs'] == 0
+  # nested arenas holding the same interned ref each release their own
+  with model.arena():
+    model.JSONToRef(True)
+    with model.arena():
+      model.JSONToRef(True)
+  assert model.getStats()['liveRefs'] == 0
+
+def testThreads():
+  model = TestDistributionSystem().getModel()
+  # a ref interned by another thread survives this thread's arena
+  held = []
+  thread = threading.Thread(target=lambda: held.append(model.JSONToRef(0.5)))
+  thread.start()
+  thread.join()
+  with model.arena():
+    model.JSONToRef(0.5)
+  assert model.refToJSON(held[0]) == 0.5
+  # refs created on the pool's threads are tracked by the caller's arena
+  with ThreadPoolModel(model, workers=4) as pool:
+    with model.arena():
+      pool.getDistributions([DistrCall('decideBias', []) for i in range(8)])
+  assert model.getStats()['liveRefs'] == 1
+  model.modifyReferenceCount(held[0], -1)
+  assert model.getStats()['liveRefs'] == 0
+
+def testWireFormat():
+  values = [None, True, False, 0, -7, 1 << 70, 0.25, float('inf'), '', 'caf\u00e9',
+            [1, [2.5, 'x']], {'a': [None], 'b': {'c': False}}]
+  for value in values:
+    assert wireformat.decode(wireformat.encode(value)) == value
+  # dict keys are converted to strings, as by json
+  keyed = {1: 'a', 2.5: 'b', None: 'c', False: 'd'}
+  assert wireformat.decode(wireformat.encode(keyed)) == json.loads(json.dumps(keyed))
+  model = TestDistributionSystem().getModel()
+  call = DistrCall('flipWithBias', [model.JSONToRef(3), model.JSONToRef(0.85)])
+  assert wireformat.decode(wireformat.encode(call)) == call
+  distr = model.getDistribution(call)
+  decoded = wireformat.decode(wireformat.encode(distr))
+  assert json.dumps(decoded.toJSON()) == json.dumps(distr.toJSON())
+  frame = wireformat.encodeFrame([3, distr])
+  assert wireformat.UINT32.unpack_from(frame)[0] == len(frame) - 4
+
+def testDiskCache():
+  model = TestDistributionSystem().getModel()
+  with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, 'cache.db')
+    old = PersistentCacheModel(model, path, 'v1')
+    new = PersistentCacheModel(model, path, 'v2')
+    # a process with the old fingerprint doesn't shadow the new one's entries
+    for cache in (old, new, new):
+      res = cache.getDistribution(DistrCall('decideBias', []))
+      for ref in algprob.distributionLiteralRefs(res.distribution):
+        model.modifyReferenceCount(ref, -1)
+    assert new.getStats()['hits'] == 1
+    assert old.getStats()['entries'] == 2
+    old.close()
+    new.close()
+  assert model.getStats()['liveRefs'] == 0
+
+def testAsyncServer():
+  server = AsyncModelServer(TestDistributionSystem().getModel())
+  loop = asyncio.new_event_loop()
+  port = loop.run_until_complete(server.start()).sockets[0].getsockname()[1]
+  thread = threading.Thread(target=loop.run_forever, daemon=True)
+  thread.start()
+  for binary in (False, True):
+    client = WrappedModel(SocketModelClient(
+      socket.create_connection(('127.0.0.1', port)), binary=binary))
+    try:
+      client.getDistribution(DistrCall('noSuchFunction', []))
+      assert False
+    except RemoteModelError:
+      pass
+    # the connection survives a failed query
+    res = sample(client, DistrCall('decideBias', []))
+    assert client.refToJSON(res[0]) in (0.15, 0.85)
+    client.modifyReferenceCount(res[0], -1)
+    client.wrapped.socket.close()
+  async def stop():
+    # the connections end once the server reads the clients' EOFs
+    while server.connections > 0:
+      await asyncio.sleep(0.01)
+    server.server.close()
+    await server.server.wait_closed()
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+  asyncio.run_coroutine_threadsafe(stop(), loop).result()
+  loop.call_soon_threadsafe(loop.stop)
+  thread.join()
+  loop.close()
+
+def exactPosteriorBias(model):
+  """
+  P(bias = 0.85 | three flips all True), by exact enumeration.
+  """
+  joint = ExactEngine(model).enumerateCall(DistrCall('biasAndFlips', []))
+  high = joint.probability([0.85, [True] * 3])
+  low = joint.probability([0.15, [True] * 3])
+  assert isClose(high / (high + low), 0.85 ** 3 / (0.85 ** 3 + 0.15 ** 3))
+  return high / (high + low)
+
+def allTrueEvidence(model):
+  return [ProbLabel(DistrCall('flipWithBias', [model.JSONToRef(3), model.JSONToRef(bias)]),
+                    [model.JSONToRef([True] * 3)])
+          for bias in (0.85, 0.15)]
+
+def releaseEvidence(model, evidence):
+  for label in evidence:
+    for ref in list(label.call.parameters) + list(label.result):
+      model.modifyReferenceCount(ref, -1)
+
+def testLikelihoodWeighting():
+  model = TestDistributionSystem().getModel()
+  expected = exactPosteriorBias(model)
+  evidence = allTrueEvidence(model)
+  samples = likelihoodWeighting(model, DistrCall('posteriorBias', []), evidence,
+                                5000, random.Random(1))
+  assert abs(samples.probability(lambda v: v[0] == 0.85) - expected) < 0.01
+  assert abs(samples.logEvidence() - math.log(0.5 * 0.85 ** 3 + 0.5 * 0.15 ** 3)) < 0.05
+  releaseEvidence(model, evidence)
+  assert model.getStats()['liveRefs'] == 0
+
+def testMetropolisHastings():
+  model = TestDistributionSystem().getModel()
+  expected = exactPosteriorBias(model)
+  evidence = allTrueEvidence(model)
+  sampler = MHSampler(model, DistrCall('posteriorBias', []), evidence,
+                      random.Random(1))
+  results = sampler.run(5000, burnIn=100)
+  assert abs(sum(1 for r in results if r[0] == 0.85) / len(results) - expected) < 0.01
+  assert 0 < sampler.acceptanceRate() < 1
+  releaseEvidence(model, evidence)
+  assert model.getStats()['liveRefs'] == 0
+
+def testConflictingEvidence():
+  model = TestDistributionSystem().getModel()
+  flip = DistrCall('bernouli', [model.JSONToRef(0.5)])
+  evidence = [ProbLabel(flip, [model.JSONToRef(True)]),
+              ProbLabel(flip, [model.JSONToRef(False)])]
+  for makeSampler in (lambda: MHSampler(model, DistrCall('decideBias', []), evidence),
+                      lambda: WeightedSampler(model, evidence)):
+    try:
+      makeSampler()
+      assert False
+    except ValueError as exc:
+      assert str(exc).startswith("conflicting evidence")
+
+def testSampleStore():
+  with tempfile.TemporaryDirectory() as directory:
+    writer = SampleStoreWriter(directory)
+    writer.appendRows([[1, 'a'], [2, 'b']])
+    writer.flush()
+    store = SampleStore(directory)
+    assert list(store.values(0)) == [1, 2]
+    assert list(store.values(1)) == ['a', 'b']
+    # promoting the int column to floats keeps what readers already see
+    writer.appendRows([[2.5, 'b']])
+    store.refresh()
+    assert list(store.values(0)) == [1, 2]
+    writer.close()
+    store.refresh()
+    assert store.kind(0) == 'float'
+    assert list(store.values(0)) == [1.0, 2.0, 2.5]
+    assert store.counts(1) == {'"a"': 1, '"b"': 2}
+    # a new writer replaces the store, dictionaries included
+    with SampleStoreWriter(directory) as writer:
+      writer.appendRows([[3, 'x'], [4, 'y']])
+    store.refresh()
+    assert list(store.values(1)) == ['x', 'y']
+    model = TestDistributionSystem().getModel()
+    with SampleStoreWriter(directory) as writer:
+      storeSamples(model, DistrCall('decideBias', []), 100, writer, batchSize=32)
+    store.refresh()
+    assert len(store) == 100
+    assert sum(store.counts(0).values()) == 100
+    assert model.getStats()['liveRefs'] == 0
+
+def checkComponents(graph, components):
+  """
+  Checks components against brute-force reachability: nodes share a
+  component iff. they reach each other, and every edge between components
+  goes forward in the order.
+  """
+  reach = {}
+  for node in graph:
+    seen = set()
+    todo = [node]
+    while todo:
+      for successor in graph[todo.pop()]:
+        if successor not in seen:
+          seen.add(successor)
+          todo.append(successor)
+    reach[node] = seen
+  position = {}
+  for i, component in enumerate(components):
+    for node in component:
+      assert node not in position
+      position[node] = i
+  assert set(position) == set(graph)
+  for a in graph:
+    for b in graph:
+      mutual = a == b or (b in reach[a] and a in reach[b])
+      assert (position[a] == position[b]) == mutual
+    for successor in graph[a]:
+      assert position[a] <= position[successor]
+
+def testGraphSort():
+  rng = random.Random(0)
+  for trial in range(300):
+    n = rng.randrange(1, 9)
+    edges = [(rng.randrange(n), rng.randrange(n)) for i in range(rng.randrange(2 * n + 1))]
+    graph = dict((node, []) for node in range(n))
+    incremental = graphsort.IncrementalTopologicalSort(graph)
+    for a, b in edges:
+      graph[a].append(b)
+      incremental.add_edge(a, b)
+      checkComponents(graph, incremental.components())
+    checkComponents(graph, graphsort.robust_topological_sort(graph))
+  # deep graphs don't hit the recursion limit
+  n = 100000
+  chain = dict((i, [i + 1] if i + 1 < n else []) for i in range(n))
+  assert graphsort.robust_topological_sort(chain) == [(i,) for i in range(n)]
+  chain[n - 1].append(0)
+  assert len(graphsort.strongly_connected_components(chain)) == 1
+  incremental = graphsort.IncrementalTopologicalSort()
+  for i in range(n - 1):
+    incremental.add_edge(i, i + 1)
+  incremental.add_edge(n - 1, 0)
+  assert len(incremental.components()) == 1
+  # edges added against the order, so each one reorders the chain so far
+  n = 1000
+  incremental = graphsort.IncrementalTopologicalSort()
+  for i in reversed(range(n - 1)):
+    incremental.add_edge(i, i + 1)
+  assert incremental.components() == [(i,) for i in range(n)]
+
 def testProof():
+  from proofenv import evaluateProof
   model = WrappedModel(TestDistributionSystem().getModel())
   call = DistrCall('decideBias', [])
   half = model.JSONToRef(0.5)
@@ -69,4 +453,19 @@ def testProof():
   res = evaluateProof(model, [decideBiasProof, biasTrueProof], 0)
   print(res)
 
+testExact()
+testElimination()
+testInterning()
+testRefCounts()
+testStreamSamples()
+testArena()
+testThreads()
+testWireFormat()
+testDiskCache()
+testAsyncServer()
+testLikelihoodWeighting()
+testMetropolisHastings()
+testConflictingEvidence()
+testSampleStore()
+testGraphSort()
 testProof()
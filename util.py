@@ -1,13 +1,22 @@
 
 import math
 
-def makeDataClass(cls):
+import numpy as np
+
+def makeDataClass(cls, frozen=False):
   """
   Makes cls into a data class.
 
   cls should define a nullary method, getData(), which returns all the data
   contained in the instance (in a structure such as a tuple).  makeDataCLass
   defines comparison and hashing in terms of this function.
+
+  If frozen is set, instances are immutable.  cls must then define
+  __slots__ (every base class must be slotted too): its fields, in the order
+  getData() returns them, followed by '_hash'.  Instead of assigning its
+  fields, __init__ should end by calling self.initFields(*fields).  The hash
+  is computed once and cached, and equality checks identity before
+  comparing data.
   """
 
 
@@ -46,6 +55,61 @@ def makeDataClass(cls):
     return self.getData() > other.getData()
   cls.__gt__ = clsGt
 
+  if frozen:
+    makeFrozen(cls)
+
+def makeFrozen(cls):
+  assert cls.__slots__[-1] == '_hash'
+  assert all('__slots__' in vars(c) for c in cls.__mro__[:-1])
+  setters = tuple(getattr(cls, name).__set__ for name in cls.__slots__)
+  setHash = setters[-1]
+  setters = setters[:-1]
+
+  # initFields is on every constructor's path, so the common sizes avoid a loop
+  if len(setters) == 1:
+    setFirst, = setters
+    def initFields(self, first):
+      setFirst(self, first)
+      setHash(self, None)
+  elif len(setters) == 2:
+    setFirst, setSecond = setters
+    def initFields(self, first, second):
+      setFirst(self, first)
+      setSecond(self, second)
+      setHash(self, None)
+  else:
+    def initFields(self, *values):
+      assert len(values) == len(setters)
+      for setter, value in zip(setters, values):
+        setter(self, value)
+      setHash(self, None)
+  cls.initFields = initFields
+
+  def frozenSetattr(self, name, value):
+    raise AttributeError(cls.__name__ + " is immutable")
+  cls.__setattr__ = frozenSetattr
+
+  def frozenHash(self):
+    res = self._hash
+    if res is None:
+      res = hash(cls) ^ hash(self.getData())
+      setHash(self, res)
+    return res
+  cls.__hash__ = frozenHash
+
+  def frozenEq(self, other):
+    return self is other or (other.__class__ is cls and
+                             self.getData() == other.getData())
+  cls.__eq__ = frozenEq
+
+  def frozenNe(self, other):
+    return not frozenEq(self, other)
+  cls.__ne__ = frozenNe
+
+  def frozenReduce(self):
+    return (cls, tuple(self.getData()))
+  cls.__reduce__ = frozenReduce
+
 negInfinity = float("-inf")
 
 def prettyString(value):
@@ -58,17 +122,98 @@ def prettyString(value):
 def sumByLogs(xs):
   """
   Computes math.log(sum(map(math.exp, xs))) while minimizing rounding error.
+  The sum of no terms is 0, so its log is -inf.
   """
   if len(xs) == 0:
-    return 1
+    return negInfinity
   maxLog = max(xs)
-  adjSum = sum(math.exp(x - maxLog) for x in xs)
-  if adjSum == 0:
+  if maxLog == negInfinity:
     return negInfinity
+  adjSum = sum(math.exp(x - maxLog) for x in xs)
   return math.log(adjSum) + maxLog
 
+def sumArrayByLogs(xs, axis=None):
+  """
+  sumByLogs for numpy arrays: the log of the sum of exp(xs), over the given
+  axis (or all of xs).  Slices that are empty or all -inf give -inf.
+  """
+  xs = np.asarray(xs, dtype=float)
+  if xs.size == 0:
+    if axis is None:
+      return negInfinity
+    return np.sum(xs, axis=axis) + negInfinity
+  maxLog = np.max(xs, axis=axis, keepdims=True)
+  # keep all -inf slices from turning into nan
+  maxLog = np.where(np.isfinite(maxLog), maxLog, 0.0)
+  with np.errstate(divide='ignore'):
+    res = np.log(np.sum(np.exp(xs - maxLog), axis=axis, keepdims=True)) + maxLog
+  if axis is None:
+    return float(res.reshape(()))
+  return np.squeeze(res, axis=axis)
+
+class LogSumAccumulator(object):
+  """
+  Computes sumByLogs of a stream of terms without keeping them: holds the
+  running maximum and the sum of the terms scaled by exp(-maximum).
+  Accumulators of parts of a stream (say, from parallel workers) can be
+  merged.
+  """
+
+  def __init__(self):
+    self.maxLog = negInfinity
+    self.scaledSum = 0.0
+    self.count = 0
+
+  def rescale(self, maxLog):
+    if maxLog > self.maxLog:
+      if self.maxLog != negInfinity:
+        self.scaledSum *= math.exp(self.maxLog - maxLog)
+      self.maxLog = maxLog
+
+  def add(self, x):
+    self.count += 1
+    if x == negInfinity:
+      return
+    self.rescale(x)
+    self.scaledSum += math.exp(x - self.maxLog)
+
+  def addArray(self, xs):
+    xs = np.asarray(xs, dtype=float).reshape(-1)
+    self.count += len(xs)
+    if len(xs) == 0:
+      return
+    maxLog = np.max(xs)
+    if maxLog == negInfinity:
+      return
+    self.rescale(float(maxLog))
+    self.scaledSum += float(np.sum(np.exp(xs - self.maxLog)))
+
+  def merge(self, other):
+    self.count += other.count
+    if other.maxLog == negInfinity:
+      return
+    self.rescale(other.maxLog)
+    self.scaledSum += other.scaledSum * math.exp(other.maxLog - self.maxLog)
+
+  def value(self):
+    if self.scaledSum == 0:
+      return negInfinity
+    return math.log(self.scaledSum) + self.maxLog
+
 def agrestiCoullLower(z, x, n):
+  """
+  The lower end of the Agresti-Coull interval for x successes out of n
+  trials, with z the standard normal quantile of the confidence level.
+  """
+  n2 = n + z**2
+  p = (x + z**2/2) / n2
+  return p - z * math.sqrt(p * (1 - p) / n2)
+
+def agrestiCoullUpper(z, x, n):
+  """
+  The upper end of the interval of agrestiCoullLower.
+  """
   n2 = n + z**2
   p = (x + z**2/2) / n2
-  return p - z * sqrt(p * (1 - p) / n2)
+  return p + z * math.sqrt(p * (1 - p) / n2)
 
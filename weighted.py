@@ -0,0 +1,183 @@
+import math
+import random
+
+import numpy as np
+
+from distribution import DistrCall, Distribution, LiteralRef
+from exact import ExactEngine, valueKey
+from model import Model
+from primitives import PRIMITIVES
+from proof import ProbLabel
+from sample import samplePrimitive
+from util import sumArrayByLogs
+
+import algprob
+
+class WeightedSampleSet(object):
+  """
+  Samples of a call with their log-weights, as drawn by likelihoodWeighting.
+  values[i] is the tuple of JSON result values of sample i, and logWeights a
+  numpy array of the log-weights.
+  """
+
+  def __init__(self, values, logWeights):
+    assert len(values) == len(logWeights)
+    self.values = values
+    self.logWeights = np.asarray(logWeights, dtype=float)
+
+  def __len__(self):
+    return len(self.values)
+
+  def normalizedWeights(self):
+    """
+    The weights, summing to 1 (all 0 if every sample has weight 0).
+    """
+    total = sumArrayByLogs(self.logWeights)
+    if total == -np.inf:
+      return np.zeros(len(self.values))
+    return np.exp(self.logWeights - total)
+
+  def logEvidence(self):
+    """
+    Estimates the log-probability of the evidence: the log of the mean weight.
+    """
+    if len(self.values) == 0:
+      return -np.inf
+    return sumArrayByLogs(self.logWeights) - math.log(len(self.values))
+
+  def effectiveSampleSize(self):
+    """
+    Kish's effective sample size, 1 / sum of the squared normalized weights.
+    """
+    weights = self.normalizedWeights()
+    squares = np.dot(weights, weights)
+    if squares == 0:
+      return 0.0
+    return float(1 / squares)
+
+  def probability(self, predicate):
+    """
+    The weighted probability that predicate holds of a sample's values.
+    """
+    weights = self.normalizedWeights()
+    mask = np.fromiter((bool(predicate(v)) for v in self.values), dtype=bool,
+                       count=len(self.values))
+    return float(np.sum(weights[mask]))
+
+  def marginal(self, index=0):
+    """
+    The weighted distribution of the index'th result value, as a dict from
+    valueKey to probability.
+    """
+    weights = self.normalizedWeights()
+    res = {}
+    for v, w in zip(self.values, weights):
+      key = valueKey(v[index])
+      res[key] = res.get(key, 0.0) + float(w)
+    return res
+
+
+def evidenceTable(engine, evidence):
+  """
+  Maps the call of each evidence ProbLabel, as (function, parameter keys),
+  to the keys of its result (keys as given by engine.keyOf).  Labels for the
+  same call must agree; a ValueError is raised otherwise.  Doesn't modify
+  any reference counts.
+  """
+  table = {}
+  for label in evidence:
+    assert isinstance(label, ProbLabel)
+    assert all(isinstance(p, LiteralRef) for p in label.call.parameters)
+    key = (label.call.function, tuple(map(engine.keyOf, label.call.parameters)))
+    result = tuple(map(engine.keyOf, label.result))
+    if table.get(key, result) != result:
+      raise ValueError("conflicting evidence for " + str(label.call))
+    table[key] = result
+  return table
+
+
+class WeightedSampler(object):
+  """
+  Samples calls by likelihood weighting.  Whenever a call matching the call
+  of an evidence ProbLabel is reached (comparing values, as Model.isEqual
+  does), it is not sampled: its result is clamped to the label's result and
+  the log-probability of that result is added to logWeight.
+
+  Those probabilities come from ExactEngine.logProbability, so observed calls
+  must be primitives or have finite support.  The labels' references stay
+  with the caller.
+  """
+
+  def __init__(self, model, evidence, rng=random, engine=None):
+    assert isinstance(model, Model)
+    self.model = model
+    self.rng = rng
+    self.engine = engine if engine is not None else ExactEngine(model)
+    self.observed = evidenceTable(self.engine, evidence)
+    self.observedFunctions = set(function for function, _ in self.observed)
+    self.logWeight = 0.0
+
+  def sample(self, call):
+    """
+    Samples call, consuming its references like sample.sample, and multiplies
+    the weight by the probability of any evidence clamped on the way.
+    """
+    model = self.model
+    if call.function in self.observedFunctions:
+      params = tuple(map(self.engine.keyOf, call.parameters))
+      result = self.observed.get((call.function, params))
+      if result is not None:
+        for p in call.parameters:
+          model.modifyReferenceCount(p, -1)
+        self.logWeight += self.engine.logProbability(call.function, params, result)
+        return [model.JSONToRef(self.engine.valueOf(r)) for r in result]
+    primitive = PRIMITIVES.get(call.function)
+    if primitive is not None:
+      return samplePrimitive(model, primitive, call, self.rng)
+    return self.sampleDistr(model.getDistribution(call).distribution)
+
+  def sampleDistr(self, distribution):
+    assert isinstance(distribution, Distribution)
+    model = self.model
+    plan = algprob.compileDistribution(distribution)
+    slots = plan.newSlots()
+    slotUses = plan.slotUses
+    for step in plan.steps:
+      res = self.sample(plan.resolveCall(slots, step))
+      plan.setOutputs(slots, step, res)
+      for o in step.outputs:
+        if slotUses[o] != 1:
+          model.modifyReferenceCount(slots[o], slotUses[o] - 1)
+    return plan.resolveResult(slots)
+
+
+def weightedSample(model, call, evidence, rng=random):
+  """
+  Draws one likelihood-weighted sample of call given the evidence (a list of
+  ProbLabels).  Returns (result, logWeight); the call's references are
+  consumed and the result's owned, as in sample.sample.
+  """
+  sampler = WeightedSampler(model, evidence, rng)
+  res = sampler.sample(call)
+  return res, sampler.logWeight
+
+def likelihoodWeighting(model, call, evidence, n, rng=random, engine=None):
+  """
+  Draws n likelihood-weighted samples of call given the evidence (a list of
+  ProbLabels) and returns them as a WeightedSampleSet.  The call's
+  references are consumed once.
+  """
+  assert isinstance(call, DistrCall)
+  sampler = WeightedSampler(model, evidence, rng, engine)
+  values = []
+  logWeights = np.empty(n)
+  for p in call.parameters:
+    model.modifyReferenceCount(p, n - 1)
+  for i in range(n):
+    sampler.logWeight = 0.0
+    res = sampler.sample(call)
+    values.append(tuple(map(model.refToJSON, res)))
+    for r in res:
+      model.modifyReferenceCount(r, -1)
+    logWeights[i] = sampler.logWeight
+  return WeightedSampleSet(values, logWeights)
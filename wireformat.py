@@ -0,0 +1,228 @@
+# A compact binary encoding of JSON values and distribution objects, used by
+# the binary framing mode of SocketModelClient and AsyncModelServer.
+#
+# Every value starts with a one-byte tag.  Integers and floats are 8 bytes,
+# and strings and containers are prefixed with a 4-byte length; all numbers
+# are big-endian.  A frame is a 4-byte payload length followed by the
+# encoded payload.
+
+import json
+import struct
+
+from distribution import (DistrCall, DistrCallAssignment, Distribution,
+                          LiteralRef, LocalVariable)
+from model import DistrResult
+from proof import ProofVar
+
+INT64 = struct.Struct('>q')
+UINT32 = struct.Struct('>I')
+FLOAT64 = struct.Struct('>d')
+
+def encodeInto(out, value):
+  """
+  Appends the encoding of value to the bytearray out.
+  """
+  if value is None:
+    out += b'N'
+  elif value is True:
+    out += b'T'
+  elif value is False:
+    out += b'F'
+  elif isinstance(value, int):
+    if -(1 << 63) <= value < (1 << 63):
+      out += b'i'
+      out += INT64.pack(value)
+    else:
+      out += b'I'
+      encodeString(out, str(value))
+  elif isinstance(value, float):
+    out += b'd'
+    out += FLOAT64.pack(value)
+  elif isinstance(value, str):
+    out += b's'
+    encodeString(out, value)
+  elif isinstance(value, (list, tuple)):
+    out += b'l'
+    out += UINT32.pack(len(value))
+    for v in value:
+      encodeInto(out, v)
+  elif isinstance(value, dict):
+    out += b'm'
+    out += UINT32.pack(len(value))
+    for k, v in value.items():
+      encodeString(out, dictKey(k))
+      encodeInto(out, v)
+  elif isinstance(value, LiteralRef):
+    out += b'R'
+    out += INT64.pack(value.ref)
+  elif isinstance(value, LocalVariable):
+    out += b'V'
+    encodeString(out, value.name)
+  elif isinstance(value, ProofVar):
+    out += b'P'
+    out += INT64.pack(value.varid)
+  elif isinstance(value, DistrCall):
+    out += b'C'
+    encodeCall(out, value)
+  elif isinstance(value, Distribution):
+    out += b'D'
+    encodeDistribution(out, value)
+  elif isinstance(value, DistrResult):
+    out += b'X'
+    encodeDistribution(out, value.distribution)
+    out += FLOAT64.pack(value.time)
+  else:
+    raise Exception("can't encode value of type " + type(value).__name__)
+
+def dictKey(key):
+  """
+  Converts a dict key to a string as the json module does, so dicts with
+  non-string keys read back the same in both formats.
+  """
+  if isinstance(key, str):
+    return key
+  if key is None or isinstance(key, (bool, int, float)):
+    return json.dumps(key)
+  raise TypeError("keys must be str, int, float, bool or None, not " +
+                  type(key).__name__)
+
+def encodeString(out, s):
+  data = s.encode('utf-8')
+  out += UINT32.pack(len(data))
+  out += data
+
+def encodeCall(out, call):
+  encodeString(out, call.function)
+  out += UINT32.pack(len(call.parameters))
+  for p in call.parameters:
+    encodeInto(out, p)
+
+def encodeDistribution(out, distr):
+  out += UINT32.pack(len(distr.assignments))
+  for assn in distr.assignments:
+    encodeCall(out, assn.call)
+    out += UINT32.pack(len(assn.variables))
+    for v in assn.variables:
+      encodeString(out, v)
+  out += UINT32.pack(len(distr.result))
+  for r in distr.result:
+    encodeInto(out, r)
+
+def encode(value):
+  out = bytearray()
+  encodeInto(out, value)
+  return out
+
+def encodeFrame(value):
+  """
+  Encodes value as a frame: its length followed by its encoding.
+  """
+  out = bytearray(4)
+  encodeInto(out, value)
+  UINT32.pack_into(out, 0, len(out) - 4)
+  return out
+
+
+class Decoder(object):
+  """
+  Decodes values from a buffer (anything supporting the buffer protocol,
+  such as a memoryview), starting at offset.
+  """
+
+  def __init__(self, buf, offset=0):
+    self.buf = buf
+    self.offset = offset
+
+  def readUint32(self):
+    res = UINT32.unpack_from(self.buf, self.offset)[0]
+    self.offset += 4
+    return res
+
+  def readInt64(self):
+    res = INT64.unpack_from(self.buf, self.offset)[0]
+    self.offset += 8
+    return res
+
+  def readFloat64(self):
+    res = FLOAT64.unpack_from(self.buf, self.offset)[0]
+    self.offset += 8
+    return res
+
+  def readString(self):
+    length = self.readUint32()
+    start = self.offset
+    self.offset += length
+    return bytes(self.buf[start : self.offset]).decode('utf-8')
+
+  def readCall(self):
+    function = self.readString()
+    return DistrCall(function, [self.read() for i in range(self.readUint32())])
+
+  def readDistribution(self):
+    assignments = []
+    for i in range(self.readUint32()):
+      call = self.readCall()
+      variables = [self.readString() for j in range(self.readUint32())]
+      assignments.append(DistrCallAssignment(call, variables))
+    result = [self.read() for i in range(self.readUint32())]
+    return Distribution(assignments, result)
+
+  def read(self):
+    tag = self.buf[self.offset]
+    self.offset += 1
+    if tag == 78: # N
+      return None
+    if tag == 84: # T
+      return True
+    if tag == 70: # F
+      return False
+    if tag == 105: # i
+      return self.readInt64()
+    if tag == 73: # I
+      return int(self.readString())
+    if tag == 100: # d
+      return self.readFloat64()
+    if tag == 115: # s
+      return self.readString()
+    if tag == 108: # l
+      return [self.read() for i in range(self.readUint32())]
+    if tag == 109: # m
+      res = {}
+      for i in range(self.readUint32()):
+        key = self.readString()
+        res[key] = self.read()
+      return res
+    if tag == 82: # R
+      return LiteralRef(self.readInt64())
+    if tag == 86: # V
+      return LocalVariable(self.readString())
+    if tag == 80: # P
+      return ProofVar(self.readInt64())
+    if tag == 67: # C
+      return self.readCall()
+    if tag == 68: # D
+      return self.readDistribution()
+    if tag == 88: # X
+      distr = self.readDistribution()
+      return DistrResult(distr, self.readFloat64())
+    raise Exception("bad tag in binary encoding: %r" % chr(tag))
+
+def decode(buf):
+  return Decoder(buf).read()
+
+def fromWire(value, cls):
+  """
+  Converts a value received over the wire to an instance of cls.  Values
+  arrive as instances of cls in the binary format, and as their JSON in the
+  JSON format.
+  """
+  if isinstance(value, cls):
+    return value
+  return cls.fromJSON(value)
+
+def toJSONDefault(obj):
+  """
+  For json.dumps(..., default=toJSONDefault), so objects with a toJSON
+  method can be sent in the JSON format.
+  """
+  return obj.toJSON()